@@ -1,12 +1,26 @@
 # -*- coding: utf-8 -*-
 
-import pyvisa
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from enum import Enum
+from functools import cached_property, lru_cache, partial, wraps
+from operator import attrgetter
+
 import numpy as np
 
 '''
 Python instrument driver for:  Siglent
                         Model: SDL1000X series DC electronic load
-Requires: pyvisa, numpy
+Requires: numpy, pyvisa (not needed with SocketTransport)
 
                             import siglent_sdl1000x as dev
 Class flow                  dev = Device('VISA::ADDRESS')
@@ -58,6 +72,8 @@ Note:   All operating modes contain a dictionary type called: 'values'
 *****   'values' holds two additional dictionary: 'input' and 'mode'
         These dictionary contain all the current settings for each mode
         and the settings for the input
+        'values' is read from the device the first time it is accessed,
+        and each mode object is only created the first time it is used
         
         >> dev.cc.values
         {'input': {'input_on': '0', 'short_on': '0', 'mode': 'STATIC LED'}, 
@@ -94,12 +110,188 @@ Note:   All operating modes contain a dictionary type called: 'values'
             dev.cc.dyn.slew_both(0.5)       ; set pos/neg slew to same setting
             dev.cc.dyn.on()                 ; Turn on the Input in Dyn CC mode
             
+*****
+Note:   Setters read back the new setting after every write by default
+*****   Example:
+
+            dev.write_confirm('deferred')   ; queue the read-backs
+            dev.cc.level(2)
+            dev.cc.slew_pos(0.5)
+            dev.confirm()                   ; read both back in one query
+
+            with dev.confirm_policy('never'):
+                dev.cc.level(3)             ; no read-back, 'values' keeps 3
+
+*****
+Note:   Commands can be sent together in one message with dev.batch()
+*****   Getters inside the batch return a BatchResult, its 'value' is
+        filled in when the batch is sent at the end of the with block
+        Example:
+
+            with dev.batch():
+                dev.cc.dyn.set_a_and_b(0.25, 1.5, 0.002, 0.0001)
+                dev.cc.dyn.set_slew_both(0.5)
+                level = dev.cc.level()
+            level.value                     ; '0.250000'
+
+*****
+Note:   A Device can be shared between threads, all bus access is locked
+*****   DeviceGroup runs the same operation on many loads at once
+        Example:
+
+            group = dev.DeviceGroup(['TCPIP0::load1::inst0::INSTR',
+                                     'TCPIP0::load2::inst0::INSTR'])
+            group.call('cc.level', 2)       ; set 2 A on every load
+            group.map(lambda d: d.meas.voltage())
+                                            ; ['12.000', '11.998']
+
+*****
+Note:   AsyncDevice provides the same class flow for asyncio programs
+*****   Example:
+
+            adev = await dev.AsyncDevice.open('VISA::ADDRESS')
+            await adev.cc.level(2)
+            await adev.meas.snapshot()
+
+*****
+Note:   LAN connected loads can skip pyvisa with the raw socket transport
+*****   Example:
+
+            dev = dev.Device(transport=dev.SocketTransport('192.168.1.50'))
+
+*****
+Note:   dev.trace() records every bus transaction with its latency and the
+*****   driver method that caused it
+        Example:
+
+            tracer = dev.trace()
+            dev.cc.level(2)
+            tracer.summary()                ; counts, latency histograms
+            tracer.export_chrome('trace.json')
+            dev.trace(False)
+
+*****
+Note:   dev.test.list.load() programs a whole list sequence from arrays
+*****   It validates every step before sending anything, writes in joined
+        messages, reads the table back in one bulk query and skips steps
+        already holding the same values
+        Example:
+
+            dev.test.list.load(np.linspace(0.5, 5, 10), 0.5, 0.01,
+                               mode='CURR', count=3)
+
+*****
+Note:   dev.test.prog works on whole program tables (numpy structured
+*****   arrays, one row per step). upload() only writes the cells changed
+        since the last download() or upload()
+        Example:
+
+            table = dev.test.prog.download()    ; every step, queries
+                                                ; joined 32 per message
+            table['level'][2] = 1.5
+            dev.test.prog.upload(table)         ; writes one cell
+            dev.test.prog.results()             ; ':PROG:TEST?' of all steps
+
+*****
+Note:   Setting getters can be served from a client side cache
+*****   *RST, *RCL, mode switches and front panel lock commands sent
+        through the driver clear it, dev.invalidate() clears it by hand
+        Example:
+
+            dev.cache(5.0)          ; cached getters valid for 5 s
+            dev.cc.level()          ; queried once, then from the cache
+            dev.refresh()           ; re-read all used modes in one batch
+            dev.cache(None)         ; every getter queries the load
+
+*****
+Note:   dev.snapshot() reads the settings of every mode in one batch as
+*****   typed values, dev.apply() writes only the ones that differ
+        Example:
+
+            recipe_a = dev.snapshot()
+            ...
+            dev.apply(recipe_a)             ; returns what was written
+            dev.diff(recipe_a, dev.snapshot())
+
+*****
+Note:   dev.typed(True) returns float, int, bool or Keyword enums (Mode,
+*****   TransientMode, ResistanceRange) instead of response strings, also
+        in the 'values' dictionaries
+        Example:
+
+            dev.typed(True)
+            dev.cc.level()          ; 1.5
+            dev.cc.dyn.pulse_mode() ; TransientMode.CONTINUOUS
+
+*****
+Note:   The CC, CV, CP and CR modes trace IV curves with sweep(), one bus
+*****   message per point, optional settling, averaging and extra points
+        around the knee
+        Example:
+
+            curve = dev.cc.sweep(np.linspace(0, 5, 500), settle=0.002,
+                                 average=4, refine=20)
+            curve['voltage'], curve['current'], curve['power']
+
+*****
+Note:   dev.test.ocp and dev.test.opp run() the load's own test, polling
+*****   voltage and current during the ramp. The trip level and pass/fail
+        are worked out on the host from those readings (the highest
+        current (power) measured before the voltage fell), not read from
+        the load. search() finds the trip level by bisection in the static
+        CC (CP) mode with far fewer steps
+        Example:
+
+            result = dev.test.ocp.run()
+            result['level'], result['passed'], result['samples']
+            dev.test.ocp.search(1.0, 5.0, resolution=0.01, settle=0.05)
+
+*****
+Note:   dev.test.bat.discharge() logs a battery discharge on a background
+*****   thread into one append-only file per column and integrates Ah and
+        Wh. Starting it again on the same directory, e.g. after the host
+        process crashed, resumes the log without restarting the discharge
+        Example:
+
+            session = dev.test.bat.discharge('cell_07', interval=1.0)
+            session.charge_ah, session.energy_wh
+            session.read()['voltage']
+            session.stop()
+
+*****
+Note:   dev.test.time.capture() repeats the TIME:TEST rise/fall measurement
+*****   with one round trip per capture, calling 'cycle' before each one
+        to produce a new edge, and returns the mean, std, min, max and
+        percentiles of both times
+        Example:
+
+            dev.test.time.voltage_low(1.0)
+            dev.test.time.voltage_high(11.0)
+            result = dev.test.time.capture(1000, cycle=toggle_supply)
+            result['rise']['mean'], result['rise']['p99']
+
+*****
+Note:   DeviceGroup.arm() sets every load to the BUS trigger source and
+*****   trigger() sends *TRG to all of them at once from the thread pool,
+        releasing the writes together with a barrier. The result reports
+        the spread of the dispatch times
+        Example:
+
+            dev.trigger_source('EXT')       ; single load, or 'BUS' with
+            dev.trigger()                   ; *TRG
+            group.arm()
+            group.trigger()['skew']         ; 0.00006
+
 Additional Classes:
 Measure:
     All methods are of type 'get'
     Provides all available 'single' measurement values
     Provides 'WAVE' data measurement retrieval (200 samples)
         data results in: dev.meas.wave_data  [np.array]
+    Provides several measurements with one query
+        dev.meas.snapshot(), dev.meas.poll(count, interval)
+    Provides continuous 'WAVE' streaming into a ring buffer
+        stream = dev.meas.stream(('VOLT', 'CURR'))  [WaveStream]
 Common:
     Provides methods for common 488.2 commands
     Most methods provide 'get' with no params, and set with the passed value
@@ -116,6 +308,8 @@ Validate
 ValidateInput
     Provides specific ranges, settings, etc to validate user input
     based on specified min, max settings for each individual command
+    as a table of Rule objects compiled once per class;
+    rule(name).check_many(values) validates a whole vector at once
 ValidateTest
     Provides additional validation functions specific to the ModeTest
     classes
@@ -126,33 +320,349 @@ Command
 
 '''
 
-# Tracks input: on/off, short: on/off, mode
-global_input_values = {}
+# Read-back policies for setters, see Device.write_confirm()
+WRITE_CONFIRM_POLICIES = ('always', 'never', 'deferred')
+
+# Commands switching the load's function, ':FUNC' also covers ':FUNC:TRAN'.
+# The list and program tests are switched on with ':LIST/:PROG:STAT:ON'
+FUNCTION_HEADERS = (':FUNC', ':BATT:FUNC', ':OCP:FUNC', ':OPP:FUNC')
+
+# Most commands joined with ';' into a single bus message
+MAX_MESSAGE_COMMANDS = 32
+
+# Samples returned by one 'MEAS:WAVE?' query
+WAVE_SAMPLES = 200
+
+
+# Keyword returned by the load, compares and prints as its long form and is
+# also found from a short form, Mode('CURR') is Mode.CURRENT
+class Keyword(str, Enum):
+    def __str__(self):
+        return self.value
+
+    @classmethod
+    def _missing_(cls, value):
+        value = str(value).upper()
+        for member in cls:
+            if value and member.value.startswith(value):
+                return member
+        return None
+
+
+class Mode(Keyword):
+    CURRENT = 'CURRENT'
+    VOLTAGE = 'VOLTAGE'
+    POWER = 'POWER'
+    RESISTANCE = 'RESISTANCE'
+    LED = 'LED'
+
+
+class TransientMode(Keyword):
+    CONTINUOUS = 'CONTINUOUS'
+    PULSE = 'PULSE'
+    TOGGLE = 'TOGGLE'
+
+
+class ResistanceRange(Keyword):
+    LOW = 'LOW'
+    MIDDLE = 'MIDDLE'
+    HIGH = 'HIGH'
+    UPPER = 'UPPER'
+
+
+class TriggerSource(Keyword):
+    MANUAL = 'MANUAL'
+    EXTERNAL = 'EXTERNAL'
+    BUS = 'BUS'
+
+
+def _to_float(text):
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def _to_int(text):
+    try:
+        return int(float(text))
+    except ValueError:
+        return text
+
+
+def _to_bool(text):
+    text = text.strip().upper()
+    if text in ('1', 'ON'):
+        return True
+    if text in ('0', 'OFF'):
+        return False
+    return text
+
+
+def _to_keyword(keyword):
+    def convert(text):
+        try:
+            return keyword(text.strip())
+        except ValueError:
+            return text
+    return convert
+
+
+# Response types by query header suffix, the first match wins, anything
+# else is a float. Used by Bus.convert() when typed responses are on
+RESPONSE_TYPES = (
+    (('TRAN:MODE',), _to_keyword(TransientMode)),
+    (('BATT:FUNC', 'OCP:FUNC', 'OPP:FUNC', 'TIME:TEST'), _to_bool),
+    ((':FUNC', ':FUNC:TRAN', 'LIST:MODE', 'BATT:MODE', 'PROG:MODE'),
+     _to_keyword(Mode)),
+    (('RRANG',), _to_keyword(ResistanceRange)),
+    (('TRIG:SOUR',), _to_keyword(TriggerSource)),
+    (('IRANG', 'VRANG', 'LIST:COUN', 'LIST:STEP', 'PROG:STEP', 'BATT:CAP',
+      'BATT:TIM', 'PROG:TEST'), _to_int),
+    ((':INP', ':SHOR', ':STAT', 'SYST:SENS', 'IMONI', 'VMONI', 'FAIL',
+      'PAUSE'), _to_bool),
+)
+
+
+# Converter for the responses to one query header
+def response_converter(header):
+    header = header.upper().rstrip('?')
+    if header.startswith('*'):
+        return str if header in ('*IDN', '*TST') else _to_int
+    header = ':' + header.lstrip(':')
+    for suffixes, convert in RESPONSE_TYPES:
+        if header.endswith(suffixes):
+            return convert
+    return _to_float
+
 
 class Device:
-    def __init__(self, visa_addr='TCPIP0::sdl1020x::inst0::INSTR'):
+    # 'transport' replaces the default VisaTransport, e.g.
+    #   Device(transport=SocketTransport('192.168.1.50'))
+    def __init__(self, visa_addr='TCPIP0::sdl1020x::inst0::INSTR',
+                 transport=None):
         self._address = str(visa_addr)
-        self._visa_driver = pyvisa.ResourceManager()
-        self._bus = self._visa_driver.open_resource(self._address)
-        self._bus.read_termination = '\n'
-        self._bus.write_termination = '\n'
+        if transport is None:
+            transport = VisaTransport(self._address)
+        self._bus = Bus(transport)
         self._com = Common(self._bus)
 
         # Get model and see if it is a 300W unit
         model = str(self._bus.query('*IDN?')).split(',')[1]
         high_power_models = ('SDL1030X-E', 'SDL1030X')
         high_power = model in high_power_models
-        global_input_values['model'] = model
-        global_input_values['high_power'] = high_power
-
-        self.meas = Measure(self._bus)
-        self.test = ModeTestFunctions(self._bus)
-        self.sys = System(self._bus)
-        # self.prot = Protection(self._bus)
-        self.cc = ModeCC(self._bus)
-        self.cv = ModeCV(self._bus)
-        self.cp = ModeCP(self._bus)
-        self.cr = ModeCR(self._bus)
+        self._bus.input_values['model'] = model
+        self._bus.input_values['high_power'] = high_power
+
+    # Mode objects are only built the first time they are accessed
+    @cached_property
+    def meas(self):
+        return Measure(self._bus)
+
+    @cached_property
+    def test(self):
+        return ModeTestFunctions(self._bus)
+
+    @cached_property
+    def sys(self):
+        return System(self._bus)
+
+    @cached_property
+    def prot(self):
+        return Protection(self._bus)
+
+    @cached_property
+    def cc(self):
+        return ModeCC(self._bus)
+
+    @cached_property
+    def cv(self):
+        return ModeCV(self._bus)
+
+    @cached_property
+    def cp(self):
+        return ModeCP(self._bus)
+
+    @cached_property
+    def cr(self):
+        return ModeCR(self._bus)
+
+    # Trigger source, 'MANUal', 'EXTernal' or 'BUS' for trigger()
+    def trigger_source(self, set_source=None):
+        return self.sys.trigger_source(set_source)
+
+    # Send *TRG, acted on when the trigger source is BUS
+    def trigger(self):
+        self._com.trg()
+
+    # Read-back after every setter: 'always' query the new setting,
+    # 'never' keep the value that was sent, 'deferred' queue the
+    # read-backs until confirm() reads them in one batched query
+    def write_confirm(self, policy=None):
+        if policy is None:
+            return self._bus.write_confirm
+        self._bus.set_write_confirm(policy)
+
+    # Use a read-back policy only for the setters inside the with block
+    @contextmanager
+    def confirm_policy(self, policy):
+        previous = self._bus.write_confirm
+        self._bus.set_write_confirm(policy)
+        try:
+            yield self
+        finally:
+            # Through set_write_confirm so leaving 'deferred' confirms
+            self._bus.set_write_confirm(previous)
+
+    # Attach a Tracer recording every bus transaction, or detach it with
+    # enable=False. Returns the tracer
+    def trace(self, enable=True, tracer=None):
+        if not enable:
+            tracer, self._bus.tracer = self._bus.tracer, None
+            return tracer
+        if tracer is not None or self._bus.tracer is None:
+            self._bus.tracer = tracer or Tracer()
+        return self._bus.tracer
+
+    # Return responses as float, int, bool or a Keyword enum (Mode,
+    # TransientMode, ResistanceRange) instead of strings, converted once
+    # per query by a converter chosen from its header
+    def typed(self, enable=None):
+        if enable is None:
+            return self._bus.typed
+        self._bus.set_typed(enable)
+
+    # Settings of these modes are captured by snapshot()
+    snapshot_modes = ('cc', 'cc.dyn', 'cv', 'cv.dyn', 'cp', 'cp.dyn',
+                      'cr', 'cr.dyn', 'test.led', 'test.bat', 'test.list',
+                      'test.prog', 'test.ocp', 'test.opp', 'test.time',
+                      'sys', 'prot')
+
+    # Read every setting listed in snapshot_modes in one batch, returning
+    # {'cc': {'level': 1.5, 'current_range': 30, ...}, ...} with the
+    # responses converted by response_converter(). 'only' limits it to
+    # the settings of a snapshot() like dictionary
+    def snapshot(self, only=None):
+        results = {}
+        with self.batch():
+            for path in self.snapshot_modes:
+                if only is not None and path not in only:
+                    continue
+                mode = attrgetter(path)(self)
+                results[path] = {
+                    name: getattr(mode, name)() for name in mode.settings
+                    if only is None or name in only[path]}
+        return {
+            path: {name: self._typed(result) for name, result in
+                   settings.items()}
+            for path, settings in results.items()}
+
+    # Settings of 'new' that differ from 'old', in the snapshot() layout
+    @staticmethod
+    def diff(old, new):
+        changes = {}
+        for path, settings in new.items():
+            for name, value in settings.items():
+                current = old.get(path, {}).get(name)
+                if not Device._same_setting(current, value):
+                    changes.setdefault(path, {})[name] = value
+        return changes
+
+    # Bring the load to a snapshot() state writing only the settings that
+    # differ from 'current' (when not given, the settings named in
+    # 'snapshot' are read, from the getter cache if it is on), in one
+    # batch without read-backs. Returns the settings that were written,
+    # leaving out values a setter rejected
+    def apply(self, snapshot, current=None):
+        if current is None:
+            current = self.snapshot(only=snapshot)
+        changes = self.diff(current, snapshot)
+        written = {}
+        with self.confirm_policy('never'), self.batch():
+            queued = self._bus._batch
+            for path in self.snapshot_modes:
+                if path not in changes:
+                    continue
+                mode = attrgetter(path)(self)
+                for name in mode.settings:
+                    if name not in changes[path]:
+                        continue
+                    count = len(queued)
+                    getattr(mode, name)(changes[path][name])
+                    # A rejected value is reported and nothing is queued
+                    if len(queued) > count:
+                        written.setdefault(path, {})[name] = \
+                            changes[path][name]
+        return written
+
+    # Typed value of a getter's response read inside a batch
+    @staticmethod
+    def _typed(result):
+        if not isinstance(result, BatchResult):
+            return result
+        if isinstance(result.value, str):
+            return response_converter(result.query)(result.value)
+        return result.value
+
+    # Keywords are equal when one is the short form of the other
+    @staticmethod
+    def _same_setting(current, value):
+        if current is None:
+            return False
+        if isinstance(value, str) or isinstance(current, str):
+            current, value = str(current).upper(), str(value).upper()
+            return current.startswith(value) or value.startswith(current)
+        return abs(current - value) <= 1e-9 + 1e-6 * abs(value)
+
+    # Serve setting getters from the values last read or written for up
+    # to 'ttl' seconds (float('inf') until invalidated), None turns the
+    # cache off. Returns the current ttl when called without arguments
+    def cache(self, ttl=False):
+        if ttl is False:
+            return self._bus.cache_ttl
+        self._bus.set_cache(ttl)
+
+    # Forget all cached settings and sub-modes, e.g. after the load was
+    # used from the front panel. *RST, *RCL, mode switches and front panel
+    # lock changes sent through the driver do this automatically
+    def invalidate(self):
+        self._bus.invalidate()
+
+    # Re-read the settings of every mode used so far in one batched query,
+    # refreshing their 'values' and the getter cache
+    def refresh(self):
+        self._bus.invalidate()
+        modes = []
+        pending = [value for value in self.__dict__.values()
+                   if isinstance(value, (Input, System, Protection))]
+        while pending:
+            mode = pending.pop(0)
+            modes.append(mode)
+            pending.extend(value for value in mode.__dict__.values()
+                           if isinstance(value, Input))
+        with self.batch():
+            for mode in modes:
+                if isinstance(mode, Input):
+                    mode._read_input()
+                mode._values = {
+                    'input': self._bus.input_values,
+                    'mode': mode._read_values()}
+                for values in mode._values.values():
+                    BatchResult.resolve(values)
+
+    # Read back all setter values queued by the 'deferred' policy
+    def confirm(self):
+        self._bus.confirm()
+
+    # Queue every command inside the with block and send them joined with
+    # ';' when it exits. Getters return a BatchResult holding the response
+    # once the batch has been sent.
+    #   with dev.batch():
+    #       dev.cc.dyn.set_a_and_b(0.25, 1.5, 0.002, 0.0001)
+    #       level = dev.cc.level()
+    #   level.value
+    def batch(self):
+        return self._bus.batch()
 
     ####################
     # pyvisa functions #
@@ -174,6 +684,164 @@ class Device:
         self._bus.close()
 
 
+class DeviceGroup:
+    # Runs the same operation on several devices at once from a thread pool
+    # and gathers the results in device order
+    #   group = DeviceGroup(['TCPIP0::load1::inst0::INSTR', ...])
+    #   group.call('cc.level', 2)              ; dev.cc.level(2) on every load
+    #   group.map(lambda dev: dev.meas.voltage())
+    def __init__(self, devices, max_workers=None):
+        devices = list(devices)
+        self._workers = max_workers or max(len(devices), 1)
+        self._executor = ThreadPoolExecutor(max_workers=self._workers)
+        # Devices may be passed in, or opened in parallel from addresses
+        # or transports
+        self.devices = list(self._executor.map(self._open, devices))
+
+    @staticmethod
+    def _open(dev):
+        if isinstance(dev, Device):
+            return dev
+        if isinstance(dev, Transport):
+            return Device(transport=dev)
+        return Device(dev)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.disconnect()
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __iter__(self):
+        return iter(self.devices)
+
+    def __getitem__(self, index):
+        return self.devices[index]
+
+    # Call func(device, *args, **kwargs) for every device concurrently
+    def map(self, func, *args, **kwargs):
+        futures = [
+            self._executor.submit(func, dev, *args, **kwargs)
+            for dev in self.devices]
+        return [future.result() for future in futures]
+
+    # Call a driver method by its path from Device, e.g. 'cc.level'
+    def call(self, method, *args, **kwargs):
+        getter = attrgetter(method)
+        return self.map(lambda dev: getter(dev)(*args, **kwargs))
+
+    # Set every load to the BUS trigger source (or 'source') and wait for
+    # each one to finish its pending commands, ready for trigger()
+    def arm(self, source='BUS'):
+        def arm_device(dev):
+            dev.trigger_source(source)
+            return dev.query('*OPC?')
+        self.map(arm_device)
+
+    # Send *TRG to every load at once. Each worker holds its device's bus
+    # lock before meeting the others at a barrier, so only the write is
+    # left after the release. Returns {'sent', 'done'}, the time each write
+    # started and returned relative to the first start, in device order,
+    # and 'skew', the spread of the start times (s). Needs a worker per
+    # device and is not meant for Device.batch()
+    #   group.arm()
+    #   group.trigger()['skew']                 ; 0.00012
+    def trigger(self, timeout=5.0):
+        if self._workers < len(self.devices):
+            print(Validate().error_text('WARNING', ValueError(
+                'ValueError!\ntrigger() needs a worker per device, '
+                'max_workers is ' + str(self._workers))))
+            return None
+        barrier = threading.Barrier(max(len(self.devices), 1))
+
+        def trigger_device(dev):
+            with dev._bus.lock:
+                barrier.wait(timeout)
+                sent = time.perf_counter()
+                dev._bus.write('*TRG')
+                return sent, time.perf_counter()
+
+        times = np.array(self.map(trigger_device)).reshape(-1, 2)
+        times -= times[:, 0].min() if len(times) else 0.0
+        return {'sent': times[:, 0],
+                'done': times[:, 1],
+                'skew': float(np.ptp(times[:, 0])) if len(times) else 0.0}
+
+    def disconnect(self):
+        self.map(Device.disconnect)
+        self._executor.shutdown()
+
+
+class AsyncDevice:
+    # asyncio front end mirroring the Device class tree. Each driver call
+    # is run in an executor (the event loop's default pool unless one is
+    # given) so many loads can be driven without a thread per device.
+    #   adev = await AsyncDevice.open('TCPIP0::sdl1020x::inst0::INSTR')
+    #   await adev.cc.level(2)
+    #   await adev.meas.snapshot()
+    #   await adev.run(setup)           ; setup(dev) runs in one worker call
+    def __init__(self, device, executor=None):
+        self._device = device
+        self._executor = executor
+        self._proxy = _AsyncProxy(device, self._call)
+
+    @classmethod
+    async def open(cls, visa_addr='TCPIP0::sdl1020x::inst0::INSTR',
+                   executor=None, **kwargs):
+        loop = asyncio.get_running_loop()
+        device = await loop.run_in_executor(
+            executor, partial(Device, visa_addr, **kwargs))
+        return cls(device, executor)
+
+    @property
+    def device(self):
+        return self._device
+
+    def __getattr__(self, name):
+        return getattr(self._proxy, name)
+
+    async def _call(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, partial(func, *args, **kwargs))
+
+    # Run func(device, *args) in one executor call, e.g. a 'with
+    # dev.batch():' sequence, since batches are kept per thread
+    async def run(self, func, *args, **kwargs):
+        return await self._call(func, self._device, *args, **kwargs)
+
+    async def disconnect(self):
+        await self._call(self._device.disconnect)
+
+
+class _AsyncProxy:
+    # Wraps a driver object: methods and I/O properties (e.g. 'values')
+    # become coroutines, child mode objects are wrapped in turn
+    def __init__(self, target, call):
+        self._target = target
+        self._call = call
+        self._children = {}
+
+    def __getattr__(self, name):
+        if name in self._children:
+            return self._children[name]
+        if isinstance(getattr(type(self._target), name, None), property):
+            return self._call(getattr, self._target, name)
+        attr = getattr(self._target, name)
+        if callable(attr):
+            @wraps(attr)
+            async def method(*args, **kwargs):
+                return await self._call(attr, *args, **kwargs)
+            return method
+        if hasattr(attr, '_bus'):
+            self._children[name] = _AsyncProxy(attr, self._call)
+            return self._children[name]
+        return attr
+
+
 class Common:
     def __init__(self, bus):
         self._bus = bus
@@ -264,13 +932,46 @@ class Common:
 
 
 class Input:
+    # Setters captured by Device.snapshot(), in the order apply() uses them
+    settings = ()
 
     def __init__(self, bus):
         self._bus = bus
         self._validate = ValidateInput(self._bus)
         self._command = Command(self._bus)
-        global_input_values['input_on'] = self.input_control()
-        global_input_values['short_on'] = self._short()
+        self._values = None
+
+    # Settings are read from the device the first time 'values' is accessed
+    @property
+    def values(self):
+        if self._values is None:
+            self._read_input()
+            self._values = {
+                'input': self._bus.input_values,
+                'mode': self._read_values()}
+            for values in self._values.values():
+                BatchResult.resolve(values)
+        return self._values
+
+    def _read_input(self):
+        self._bus.input_values['input_on'] = self.input_control()
+        self._bus.input_values['short_on'] = self._short()
+        if 'mode' not in self._bus.input_values:
+            self._set_mode_name('STATIC', self._command.read(':FUNC?'))
+
+    # input_values['mode'] such as 'STATIC CURRENT', set once the response
+    # arrives when the mode query was queued in a batch
+    def _set_mode_name(self, kind, value):
+        def set_name(value):
+            self._bus.input_values['mode'] = kind + ' ' + str(value)
+        if isinstance(value, BatchResult):
+            value.then(set_name)
+        else:
+            set_name(value)
+
+    # Overridden by each mode to fill and return its settings dictionary
+    def _read_values(self):
+        return {}
 
     #####################
     # Input sink enable #
@@ -281,7 +982,7 @@ class Input:
         write = ':INP'
         return self._command.read_write(
             query, write, self._validate.on_off,
-            set_input_on_off, global_input_values, 'input_on')
+            set_input_on_off, self._bus.input_values, 'input_on')
 
     def on(self):
         self.input_control('ON')
@@ -295,10 +996,18 @@ class Input:
         write = ':SHOR'
         return self._command.read_write(
             query, write, self._validate.on_off,
-            set_short, global_input_values, 'short_on')
+            set_short, self._bus.input_values, 'short_on')
 
 
 class Measure:
+    # Scalar measurement queries by quantity name
+    _queries = {
+        'voltage': 'MEAS:VOLT?',
+        'current': 'MEAS:CURR?',
+        'power': 'MEAS:POW?',
+        'resistance': 'MEAS:RES?',
+        'external': 'MEAS:EXT?'}
+
     def __init__(self, bus):
         self._bus = bus
         self._command = Command(self._bus)
@@ -307,9 +1016,22 @@ class Measure:
     def __wave_data(self, meas_source: str):
         self.wave_data.clear()
         query = 'MEAS:WAVE? ' + meas_source
-        raw = self._command.read(query)
-        split_raw = raw.split(',')
-        self.wave_data[meas_source] = np.array(np.single(split_raw[0:-1]), dtype='f')
+        raw = self._command.read_raw(query)
+        self.wave_data[meas_source] = self.parse_wave(raw)
+
+    # Decode a raw 'MEAS:WAVE?' response (comma separated ASCII floats with
+    # a trailing comma) straight from bytes into a float32 array.
+    # With 'out' the fields are converted once, directly into that buffer
+    # (clipped to its length), and the filled part of it is returned
+    @staticmethod
+    def parse_wave(raw, out=None):
+        raw = raw.rstrip(b',\r\n ')
+        if out is None:
+            return np.fromstring(raw, dtype=np.float32, sep=',')
+        fields = raw.split(b',') if raw else []
+        n = min(len(fields), len(out))
+        out[:n] = fields[:n]
+        return out[:n]
 
     def voltage(self):
         query = 'MEAS:VOLT?'
@@ -331,6 +1053,37 @@ class Measure:
         query = 'MEAS:EXT?'
         return self._command.read(query)
 
+    # One query for several measurements, joined with ';'
+    def _snapshot_query(self, quantities):
+        return Bus.join([self._queries[name] for name in quantities])
+
+    # Read several measurements with one query
+    #   dev.meas.snapshot()  ; {'voltage': 12.0, 'current': 1.5, 'power': 18.0}
+    def snapshot(self, quantities=('voltage', 'current', 'power')):
+        values = self._bus.query_values(self._snapshot_query(quantities))
+        return dict(zip(quantities, values.tolist()))
+
+    # Take 'count' snapshots every 'interval' seconds into a structured array
+    # with a 'time' column and one column per quantity
+    #   data = dev.meas.poll(200, 0.05)
+    #   data['voltage'], data['time']
+    def poll(self, count, interval=0.0,
+             quantities=('voltage', 'current', 'power')):
+        query = self._snapshot_query(quantities)
+        data = np.zeros(int(count), dtype=[('time', 'f8')] + [
+            (name, 'f8') for name in quantities])
+        columns = [data[name] for name in quantities]
+        start = time.perf_counter()
+        for i in range(len(data)):
+            delay = start + i * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            data['time'][i] = time.time()
+            values = self._bus.query_values(query)
+            for column, value in zip(columns, values):
+                column[i] = value
+        return data
+
     def wave_current(self):
         self.__wave_data('CURR')
 
@@ -343,41 +1096,223 @@ class Measure:
     def wave_resistance(self):
         self.__wave_data('RES')
 
+    # Start streaming 'MEAS:WAVE?' captures into a ring buffer, see WaveStream
+    def stream(self, sources=('VOLT', 'CURR'), capacity=1000, interval=0.0):
+        wave_stream = WaveStream(self, sources, capacity, interval)
+        wave_stream.start()
+        return wave_stream
+
+
+class WaveStream:
+    # Background reader that repeatedly fetches 'MEAS:WAVE?' for each source
+    # into a fixed size ring buffer of 'capacity' captures per source.
+    # The buffer is stored twice back to back, so the latest captures are
+    # always a contiguous slice and are returned as views without copying.
+    # A view is overwritten once 'capacity' newer captures have arrived.
+    #   stream = dev.meas.stream(('VOLT', 'CURR'), capacity=36000)
+    #   t, volt = stream.latest('VOLT', 10)  ; last 10 captures (10, 200)
+    #   stream.stop()
+    def __init__(self, measure, sources=('VOLT', 'CURR'), capacity=1000,
+                 interval=0.0):
+        self._measure = measure
+        self._command = measure._command
+        self.sources = tuple(str(source).upper() for source in sources)
+        self.capacity = int(capacity)
+        self.interval = interval
+        self.count = 0
+        self.error = None
+        self._queries = {
+            source: 'MEAS:WAVE? ' + source for source in self.sources}
+        self._data = {
+            source: np.zeros((2 * self.capacity, WAVE_SAMPLES), dtype='f')
+            for source in self.sources}
+        self._time = np.zeros(2 * self.capacity)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        if not self.running:
+            self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='WaveStream', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                self.capture()
+                if self.interval:
+                    self._stop.wait(self.interval)
+        except Exception as error:
+            self.error = error
+
+    # Fetch one capture of every source into the next ring slot, samples
+    # missing from a short reply are NaN
+    def capture(self):
+        slot = self.count % self.capacity
+        for source in self.sources:
+            raw = self._command.read_raw(self._queries[source])
+            data = self._data[source]
+            n = len(Measure.parse_wave(raw, out=data[slot]))
+            data[slot, n:] = np.nan
+            data[slot + self.capacity] = data[slot]
+        self._time[slot] = self._time[slot + self.capacity] = time.time()
+        self.count += 1
+
+    # Slice of the mirrored buffer holding the latest n captures
+    def _window(self, n):
+        n = min(int(n), self.count, self.capacity)
+        end = (self.count - 1) % self.capacity + self.capacity + 1
+        return slice(end - n, end)
+
+    # Timestamps (n,) and samples (n, 200) of the latest n captures
+    def latest(self, source, n=1):
+        window = self._window(n)
+        return self._time[window], self._data[str(source).upper()][window]
+
+    # The latest n samples of a source as one flat array
+    def samples(self, source, n=WAVE_SAMPLES):
+        captures = -(-int(n) // WAVE_SAMPLES)
+        _, data = self.latest(source, captures)
+        return data.reshape(-1)[-int(n):]
+
 
 class ModeStatic(Input):
+    # Level command and validator of the mode, used by sweep()
+    level_header = None
+    level_validator = None
+    sweep_dtype = np.dtype([('set', 'f8'), ('voltage', 'f8'),
+                            ('current', 'f8'), ('power', 'f8'),
+                            ('time', 'f8')])
+
     def __init__(self, bus):
         self._bus = bus
         Input.__init__(self, bus)
-        # Default to static CC mode
-        self._mode('CURR')
 
     def _mode(self, set_static_mode=None):
         query = ':FUNC?'
         write = ':FUNC'
         rvalue = self._command.read_write(
             query, write, self._validate.mode_static,
-            set_static_mode, global_input_values, 'mode')
+            set_static_mode, self._bus.input_values, 'mode')
         if rvalue is None:
-            value = self._command.read(query)
-            global_input_values['mode'] = str('STATIC ' + str(value))
+            self._set_mode_name('STATIC', self._command.read(query))
         return rvalue
 
+    # Trace an IV curve: step the level through 'setpoints', wait 'settle'
+    # seconds at each point and average 'average' voltage and current
+    # readings. Each bus message reads the present point and sets the next
+    # one, so a point costs one round trip. 'refine' extra points are then
+    # measured around the knee, where the voltage curve bends the most.
+    # With switch_input the mode is enabled and the input is on only for
+    # the sweep. Returns a sweep_dtype array (set, voltage, current, power,
+    # time since the start) sorted by set. Not meant for Device.batch()
+    #   curve = dev.cc.sweep(np.linspace(0, 5, 500), settle=0.002)
+    def sweep(self, setpoints, settle=0.0, average=1, refine=0,
+              switch_input=True):
+        if self.level_header is None:
+            print(self._command.error_text('WARNING', TypeError(
+                'TypeError!\nsweep() is not available in this mode')))
+            return None
+        rule = self._validate.rule(self.level_validator)
+        levels = rule.check_many(np.asarray(setpoints, dtype=float))
+        if isinstance(levels, (ValueError, TypeError)):
+            print(self._command.error_text('WARNING', levels))
+            return None
+        start = time.perf_counter()
+        # The input is turned off even when the sweep fails part way
+        with self._bus.lock:
+            try:
+                if switch_input:
+                    self.enable()
+                data = self._sweep_points(
+                    levels, settle, average, start, switch_input)
+                if refine > 0 and len(data) >= 3:
+                    data = np.sort(data, order='set')
+                    extra = rule.check_many(self._knee_points(data, refine))
+                    data = np.concatenate([data, self._sweep_points(
+                        extra, settle, average, start)])
+            finally:
+                if switch_input:
+                    self.input_control('OFF')
+        return np.sort(data, order='set')
+
+    # Measure each level, setting the next one in the same message
+    def _sweep_points(self, levels, settle, average, start,
+                      input_on=False):
+        data = np.zeros(len(levels), dtype=self.sweep_dtype)
+        if not len(levels):
+            return data
+        measure = Bus.join(['MEAS:VOLT?', 'MEAS:CURR?'] * int(average))
+        self._bus.write(self.level_header + ' ' + levels[0])
+        if input_on:
+            self.input_control('ON')
+        for i in range(len(levels)):
+            if settle > 0:
+                time.sleep(settle)
+            message = measure
+            if i + 1 < len(levels):
+                message += ';' + self.level_header + ' ' + levels[i + 1]
+            values = self._bus.query_values(message)
+            data['time'][i] = time.perf_counter() - start
+            data['voltage'][i] = values[0::2].mean()
+            data['current'][i] = values[1::2].mean()
+        data['set'] = np.asarray(levels, dtype=float)
+        data['power'] = data['voltage'] * data['current']
+        return data
+
+    # 'count' levels between the neighbours of the sharpest bend in the
+    # voltage of a sweep sorted by set
+    @staticmethod
+    def _knee_points(data, count):
+        voltage = data['voltage'] / (np.ptp(data['voltage']) or 1.0)
+        knee = int(np.argmax(np.abs(np.diff(voltage, 2)))) + 1
+        low, high = data['set'][knee - 1], data['set'][knee + 1]
+        return np.linspace(low, high, int(count) + 2)[1:-1]
+
 
 class ModeCC(ModeStatic):
+    level_header = ':CURR'
+    level_validator = 'current'
+    settings = ('current_range', 'voltage_range', 'level',
+                'slew_pos', 'slew_neg')
+
     def __init__(self, bus):
         self._bus = bus
         ModeStatic.__init__(self, bus)
         self._mode_cc = {}
-        self._mode_cc = {
+
+    @cached_property
+    def dyn(self):
+        return ModeDynamicCC(self._bus)
+
+    def _read_values(self):
+        self._mode_cc.update({
             'level': self.level(),
             'current_range': self.current_range(),
             'voltage_range': self.voltage_range(),
             'slew_pos': self.slew_pos(),
-            'slew_neg': self.slew_pos()}
-        self.values = {
-            'input': global_input_values,
-            'mode': self._mode_cc}
-        self.dyn = ModeDynamicCC(self._bus)
+            'slew_neg': self.slew_neg()})
+        return self._mode_cc
 
     def on(self):
         self.enable()
@@ -427,19 +1362,25 @@ class ModeCC(ModeStatic):
 
 
 class ModeCV(ModeStatic):
+    level_header = ':VOLT'
+    level_validator = 'voltage'
+    settings = ('current_range', 'voltage_range', 'level')
+
     def __init__(self, bus):
         self._bus = bus
         ModeStatic.__init__(self, bus)
         self._mode_cv = {}
-        self._mode_cv = {
+
+    @cached_property
+    def dyn(self):
+        return ModeDynamicCV(self._bus)
+
+    def _read_values(self):
+        self._mode_cv.update({
             'level': self.level(),
             'current_range': self.current_range(),
-            'voltage_range': self.voltage_range()}
-        self.values = {
-            'input': global_input_values,
-            'mode': self._mode_cv}
-
-        self.dyn = ModeDynamicCV(self._bus)
+            'voltage_range': self.voltage_range()})
+        return self._mode_cv
 
     def on(self):
         self.enable()
@@ -471,19 +1412,25 @@ class ModeCV(ModeStatic):
 
 
 class ModeCP(ModeStatic):
+    level_header = ':POW'
+    level_validator = 'power'
+    settings = ('current_range', 'voltage_range', 'level')
+
     def __init__(self, bus):
         self._bus = bus
         ModeStatic.__init__(self, bus)
         self._mode_cp = {}
-        self._mode_cp = {
+
+    @cached_property
+    def dyn(self):
+        return ModeDynamicCP(self._bus)
+
+    def _read_values(self):
+        self._mode_cp.update({
             'level': self.level(),
             'current_range': self.current_range(),
-            'voltage_range': self.voltage_range()}
-        self.values = {
-            'input': global_input_values,
-            'mode': self._mode_cp}
-
-        self.dyn = ModeDynamicCP(self._bus)
+            'voltage_range': self.voltage_range()})
+        return self._mode_cp
 
     def on(self):
         self.enable()
@@ -515,20 +1462,27 @@ class ModeCP(ModeStatic):
 
 
 class ModeCR(ModeStatic):
+    level_header = ':RES'
+    level_validator = 'resistance'
+    settings = ('current_range', 'voltage_range', 'resistance_range',
+                'level')
+
     def __init__(self, bus):
         self._bus = bus
         ModeStatic.__init__(self, bus)
         self._mode_cr = {}
-        self._mode_cr = {
+
+    @cached_property
+    def dyn(self):
+        return ModeDynamicCR(self._bus)
+
+    def _read_values(self):
+        self._mode_cr.update({
             'level': self.level(),
             'current_range': self.current_range(),
             'voltage_range': self.voltage_range(),
-            'resistance_range': self.resistance_range()}
-        self.values = {
-            'input': global_input_values,
-            'mode': self._mode_cr}
-
-        self.dyn = ModeDynamicCR(self._bus)
+            'resistance_range': self.resistance_range()})
+        return self._mode_cr
 
     def on(self):
         self.enable()
@@ -567,20 +1521,23 @@ class ModeCR(ModeStatic):
 
 
 class ModeLED(ModeStatic):
+    settings = ('current_range', 'voltage_range', 'voltage', 'current',
+                'rco')
+
     def __init__(self, bus):
         self._bus = bus
         Input.__init__(self, bus)
         self._validate = ValidateTest(self._bus)
         self._mode_led = {}
-        self._mode_led = {
+
+    def _read_values(self):
+        self._mode_led.update({
             'voltage': self.voltage(),
             'current': self.current(),
             'current_range': self.current_range(),
             'voltage_range': self.voltage_range(),
-            'rco': self.rco()}
-        self.values = {
-            'input': global_input_values,
-            'mode': self._mode_led}
+            'rco': self.rco()})
+        return self._mode_led
 
     def on(self):
         self.enable()
@@ -629,26 +1586,30 @@ class ModeDynamic(Input):
     def __init__(self, bus):
         self._bus = bus
         Input.__init__(self, bus)
-        global_input_values['mode'] = self._mode()
 
     def _mode(self, set_dynamic_mode=None):
         query = ':FUNC:TRAN?'
         write = ':FUNC:TRAN'
         rvalue = self._command.read_write(
             query, write, self._validate.mode_dynamic,
-            set_dynamic_mode, global_input_values, 'mode')
+            set_dynamic_mode, self._bus.input_values, 'mode')
         if rvalue is None:
-            value = self._command.read(query)
-            global_input_values['mode'] = str('DYNAMIC ' + str(value))
+            self._set_mode_name('DYNAMIC', self._command.read(query))
         return rvalue
 
 
 class ModeDynamicCC(ModeDynamic):
+    settings = ('current_range', 'voltage_range', 'pulse_mode',
+                'a_level', 'b_level', 'a_width', 'b_width',
+                'slew_pos', 'slew_neg')
+
     def __init__(self, bus):
         self._bus = bus
         ModeDynamic.__init__(self, bus)
         self._mode_cc_dyn = {}
-        self._mode_cc_dyn = {
+
+    def _read_values(self):
+        self._mode_cc_dyn.update({
             'pulse_mode': self.pulse_mode(),
             'a_level': self.a_level(),
             'b_level': self.b_level(),
@@ -657,10 +1618,8 @@ class ModeDynamicCC(ModeDynamic):
             'current_range': self.current_range(),
             'voltage_range': self.voltage_range(),
             'slew_pos': self.slew_pos(),
-            'slew_neg': self.slew_neg()}
-        self.values = {
-            'input': global_input_values,
-            'mode': self._mode_cc_dyn}
+            'slew_neg': self.slew_neg()})
+        return self._mode_cc_dyn
 
     def on(self):
         self.enable()
@@ -744,21 +1703,24 @@ class ModeDynamicCC(ModeDynamic):
 
 
 class ModeDynamicCV(ModeDynamic):
+    settings = ('current_range', 'voltage_range', 'pulse_mode',
+                'a_level', 'b_level', 'a_width', 'b_width')
+
     def __init__(self, bus):
         self._bus = bus
         ModeDynamic.__init__(self, bus)
         self._mode_cv_dyn = {}
-        self._mode_cv_dyn = {
+
+    def _read_values(self):
+        self._mode_cv_dyn.update({
             'pulse_mode': self.pulse_mode(),
             'a_level': self.a_level(),
             'b_level': self.b_level(),
             'a_width': self.a_width(),
             'b_width': self.b_width(),
             'current_range': self.current_range(),
-            'voltage_range': self.voltage_range()}
-        self.values = {
-            'input': global_input_values,
-            'mode': self._mode_cv_dyn}
+            'voltage_range': self.voltage_range()})
+        return self._mode_cv_dyn
 
     def on(self):
         self.enable()
@@ -824,21 +1786,24 @@ class ModeDynamicCV(ModeDynamic):
 
 
 class ModeDynamicCP(ModeDynamic):
+    settings = ('current_range', 'voltage_range', 'pulse_mode',
+                'a_level', 'b_level', 'a_width', 'b_width')
+
     def __init__(self, bus):
         self._bus = bus
         ModeDynamic.__init__(self, bus)
         self._mode_cp_dyn = {}
-        self._mode_cp_dyn = {
+
+    def _read_values(self):
+        self._mode_cp_dyn.update({
             'pulse_mode': self.pulse_mode(),
             'a_level': self.a_level(),
             'b_level': self.b_level(),
             'a_width': self.a_width(),
             'b_width': self.b_width(),
             'current_range': self.current_range(),
-            'voltage_range': self.voltage_range()}
-        self.values = {
-            'input': global_input_values,
-            'mode': self._mode_cp_dyn}
+            'voltage_range': self.voltage_range()})
+        return self._mode_cp_dyn
 
     def on(self):
         self.enable()
@@ -904,11 +1869,16 @@ class ModeDynamicCP(ModeDynamic):
 
 
 class ModeDynamicCR(ModeDynamic):
+    settings = ('current_range', 'voltage_range', 'resistance_range',
+                'pulse_mode', 'a_level', 'b_level', 'a_width', 'b_width')
+
     def __init__(self, bus):
         self._bus = bus
         ModeDynamic.__init__(self, bus)
         self._mode_cr_dyn = {}
-        self._mode_cr_dyn = {
+
+    def _read_values(self):
+        self._mode_cr_dyn.update({
             'enable': self.get_enable(),
             'pulse_mode': self.pulse_mode(),
             'a_level': self.a_level(),
@@ -917,10 +1887,8 @@ class ModeDynamicCR(ModeDynamic):
             'b_width': self.b_width(),
             'current_range': self.current_range(),
             'voltage_range': self.voltage_range(),
-            'resistance_range': self.resistance_range()}
-        self.values = {
-            'input': global_input_values,
-            'mode': self._mode_cr_dyn}
+            'resistance_range': self.resistance_range()})
+        return self._mode_cr_dyn
 
     def on(self):
         self.enable()
@@ -1001,22 +1969,50 @@ class ModeTestFunctions(Input):
         self._bus = bus
         Input.__init__(self, bus)
 
-        self.led = ModeLED(self._bus)
-        self.bat = ModeBattery(self._bus)
-        self.list = ModeList(self._bus)
-        self.ocp = ModeOCP(self._bus)
-        self.opp = ModeOPP(self._bus)
-        self.prog = ModeProgram(self._bus)
-        # self.test = ModeTest(self._bus)
+    @cached_property
+    def led(self):
+        return ModeLED(self._bus)
+
+    @cached_property
+    def bat(self):
+        return ModeBattery(self._bus)
+
+    @cached_property
+    def list(self):
+        return ModeList(self._bus)
+
+    @cached_property
+    def ocp(self):
+        return ModeOCP(self._bus)
+
+    @cached_property
+    def opp(self):
+        return ModeOPP(self._bus)
+
+    @cached_property
+    def prog(self):
+        return ModeProgram(self._bus)
+
+    @cached_property
+    def time(self):
+        return ModeTime(self._bus)
 
 
 class ModeList(Input):
+    settings = ('list_mode', 'current_range', 'voltage_range',
+                'resistance_range', 'count', 'step')
+
     def __init__(self, bus):
         self._bus = bus
         Input.__init__(self, bus)
         self._validate = ValidateTest(self._bus)
         self._mode_list = {}
-        self._mode_list = {
+        # Read-back of the steps sent by load(), step: (level, slew, width)
+        self._steps = {}
+        self._steps_generation = bus.generation
+
+    def _read_values(self):
+        self._mode_list.update({
             'enable': self.get_enable(),
             'list_mode': self.list_mode(),
             'level': self.level(),
@@ -1026,10 +2022,8 @@ class ModeList(Input):
             'width': self.width(),
             'current_range': self.current_range(),
             'voltage_range': self.voltage_range(),
-            'resistance_range': self.resistance_range()}
-        self.values = {
-            'input': global_input_values,
-            'mode': self._mode_list}
+            'resistance_range': self.resistance_range()})
+        return self._mode_list
 
     def on(self):
         self.enable()
@@ -1037,7 +2031,7 @@ class ModeList(Input):
 
     def enable(self):
         write = ':LIST:STAT:ON'
-        self.values['input']['mode'] = 'LIST'
+        self._bus.input_values['mode'] = 'LIST'
         self._command.write(write)
 
     def get_enable(self):
@@ -1048,13 +2042,15 @@ class ModeList(Input):
         query = ':LIST:MODE?'
         write = ':LIST:MODE'
         return self._command.read_write(
-            query, write, self._validate.current,
+            query, write, self._validate.mode_list,
             set_list_mode, self._mode_list, 'list_mode')
 
     def level(self, step=1, set_level=None):
         query = ':LIST:LEV? ' + str(step)
         write = ':LIST:LEV ' + str(step) + ','
         self._validate.step_range(step)
+        if set_level is not None:
+            self._steps.pop(step, None)
         return self._command.read_write(
             query, write, self._validate.list_levels,
             set_level, self._mode_list, 'level')
@@ -1091,12 +2087,15 @@ class ModeList(Input):
         query = ':LIST:STEP?'
         write = ':LIST:STEP'
         return self._command.read_write(
-            query, write, self._validate.step_range,
+            query, write, self._validate.list_steps,
             set_step, self._mode_list, 'step')
 
     def slew(self, step=1, set_slew=None):
         query = ':LIST:SLEW? ' + str(step)
-        write = ':CURR:SLEW ' + str(step) + ','
+        write = ':LIST:SLEW ' + str(step) + ','
+        self._validate.step_range(step)
+        if set_slew is not None:
+            self._steps.pop(step, None)
         return self._command.read_write(
             query, write, self._validate.slew,
             set_slew, self._mode_list, 'slew')
@@ -1105,18 +2104,132 @@ class ModeList(Input):
         query = ':LIST:WID? ' + str(step)
         write = ':LIST:WID ' + str(step) + ','
         self._validate.step_range(step)
+        if set_width is not None:
+            self._steps.pop(step, None)
         return self._command.read_write(
             query, write, self._validate.pulse_width,
             set_width, self._mode_list, 'width')
 
+    # Program the whole list from arrays of per-step levels, slews and
+    # widths (a scalar applies to every step, None leaves it unchanged).
+    # Everything is validated before anything is sent, then written in
+    # joined messages and checked with one bulk read-back. Steps already
+    # holding the same values from an earlier load() are skipped unless
+    # 'force' is set. Returns the steps whose read-back differs.
+    # Not meant to be called inside Device.batch()
+    def load(self, levels, slews=None, widths=None,
+             mode=None, count=None, force=False):
+        levels = np.asarray(levels)
+        steps = len(levels)
+        columns = {'level': levels, 'slew': slews, 'width': widths}
+        checks = [('step', self._validate.rules['list_steps'], steps)]
+        if mode is not None:
+            checks.append(('mode', self._validate.rules['mode_list'], mode))
+        if count is not None:
+            checks.append(
+                ('count', self._validate.rules['list_count'], count))
+        for name, rule, value in checks:
+            val = rule.check(value)
+            if isinstance(val, (ValueError, TypeError)):
+                print(self._command.error_text('WARNING', val))
+                return None
+            if name == 'mode':
+                mode = val
+        rules = {
+            'level': (self._validate.level_rule(mode) if mode is not None
+                      else self._validate.rule('list_levels')),
+            'slew': self._validate.rules['slew'],
+            'width': self._validate.rules['pulse_width']}
+        sent = {}
+        for name, values in columns.items():
+            if values is None:
+                continue
+            if np.ndim(values) == 0:
+                values = np.full(steps, values)
+            if len(values) != steps:
+                print(self._command.error_text('WARNING', ValueError(
+                    'ValueError!\n{} has {} steps, levels has {}'.format(
+                        name, len(values), steps))))
+                return None
+            val = rules[name].check_many(values)
+            if isinstance(val, (ValueError, TypeError)):
+                print(self._command.error_text('WARNING', val))
+                return None
+            sent[name] = val
+
+        if force or self._steps_generation != self._bus.generation:
+            self._steps = {}
+            self._steps_generation = self._bus.generation
+        settings = [
+            (header, key, value) for header, key, value in (
+                (':LIST:MODE', 'list_mode', mode),
+                (':LIST:STEP', 'step', steps),
+                (':LIST:COUN', 'count', count))
+            if value is not None]
+        headers = {'level': ':LIST:LEV', 'slew': ':LIST:SLEW',
+                   'width': ':LIST:WID'}
+        fields = ('level', 'slew', 'width')
+        changed = []
+        with self._bus.lock:
+            with self._bus.batch():
+                for header, _, value in settings:
+                    self._bus.write(header + ' ' + str(value))
+                for name, values in sent.items():
+                    column = fields.index(name)
+                    for step, value in enumerate(values, 1):
+                        cached = self._steps.get(step)
+                        if cached is not None and \
+                                self._same(cached[column], value):
+                            continue
+                        self._bus.write('{} {},{}'.format(
+                            headers[name], step, value))
+                        changed.append((step, column, value))
+            queries = [header + '?' for header, _, _ in settings]
+            queries += ['{}? {}'.format(headers[fields[column]], step)
+                        for step, column, _ in changed]
+            responses = self._bus.query_many(queries)
+
+        for (header, key, _), response in zip(settings, responses):
+            self._mode_list[key] = response
+            self._bus.set_mode(header + '?', response)
+        mismatched = []
+        for (step, column, value), response in zip(
+                changed, responses[len(settings):]):
+            cached = list(self._steps.get(step, (None, None, None)))
+            cached[column] = response
+            self._steps[step] = tuple(cached)
+            if not self._same(response, value) and step not in mismatched:
+                mismatched.append(step)
+        if mismatched:
+            print(self._command.error_text('WARNING', ValueError(
+                'ValueError!\nRead-back differs for list steps {}'.format(
+                    mismatched))))
+        return mismatched
+
+    @staticmethod
+    def _same(response, value):
+        if response is None:
+            return False
+        try:
+            return abs(float(response) - float(value)) <= \
+                1e-9 + 1e-6 * abs(float(value))
+        except ValueError:
+            return False
+
 
 class ModeBattery(Input):
+    settings = ('mode', 'current_range', 'voltage_range',
+                'resistance_range', 'level', 'v_stop', 'c_stop', 't_stop',
+                'v_stop_enable', 'c_stop_enable', 't_stop_enable')
+
     def __init__(self, bus):
         self._bus = bus
         Input.__init__(self, bus)
         self._validate = ValidateTest(self._bus)
         self._mode_bat = {}
-        self._mode_bat = {
+
+    def _read_values(self):
+        self._mode_bat.update({
             'enable': self.get_enable(),
             'batt_mode': self.mode(),
             'level': self.level(),
@@ -1128,10 +2241,8 @@ class ModeBattery(Input):
             't_stop_state': self.t_stop_enable(),
             'current_range': self.current_range(),
             'voltage_range': self.voltage_range(),
-            'resistance_range': self.resistance_range()}
-        self.values = {
-            'input': global_input_values,
-            'mode': self._mode_bat}
+            'resistance_range': self.resistance_range()})
+        return self._mode_bat
 
     def on(self):
         self.enable()
@@ -1140,7 +2251,7 @@ class ModeBattery(Input):
     def enable(self):
         write = ':BATT:FUNC'
         self._command.write(write)
-        self.values['input']['mode'] = 'BATTERY'
+        self._bus.input_values['mode'] = 'BATTERY'
         self._mode_bat['enable'] = self.get_enable()
 
     def get_enable(self):
@@ -1200,7 +2311,7 @@ class ModeBattery(Input):
         query = ':BATT:TIM?'
         write = ':BATT:TIM'
         return self._command.read_write(
-            query, write, self._validate.on_off,
+            query, write, self._validate.timer,
             set_timer_stop, self._mode_bat, 't_stop')
 
     def v_stop_enable(self, set_v_stop_on_off=None):
@@ -1232,14 +2343,323 @@ class ModeBattery(Input):
         query = ':BATT:DISCHA:TIM?'
         return self._command.read(query)
 
+    # Log a discharge into 'directory' on a background thread, see
+    # DischargeSession. An existing session in the directory is resumed
+    def discharge(self, directory, interval=1.0, checkpoint_every=10):
+        session = DischargeSession(self, directory, interval,
+                                   checkpoint_every)
+        session.start()
+        return session
+
+
+class DischargeSession:
+    # Background logger of a battery discharge. Every 'interval' seconds
+    # one query reads voltage, current, the load's discharged capacity and
+    # time and the input state. Each column is appended as float64 to its
+    # own file in 'directory', and charge (Ah) and energy (Wh) are
+    # integrated on the host with trapezoidal sums. A checkpoint written
+    # every 'checkpoint_every' samples lets a new process resume the log
+    # of a discharge that is still running. The session ends when the load
+    # turns the input off (a stop condition was reached) or on stop().
+    #   session = dev.test.bat.discharge('cell_07')
+    #   session.charge_ah, session.energy_wh
+    #   data = session.read()       ; data['voltage'], data['capacity']
+    columns = ('time', 'voltage', 'current', 'capacity', 'timer')
+    _query = (':MEAS:VOLT?;:MEAS:CURR?;:BATT:DISCHA:CAP?;'
+              ':BATT:DISCHA:TIM?;:INP?')
+
+    def __init__(self, battery, directory, interval=1.0,
+                 checkpoint_every=10):
+        self._battery = battery
+        self._bus = battery._bus
+        self.directory = str(directory)
+        self.interval = interval
+        self.checkpoint_every = int(checkpoint_every)
+        self.count = 0
+        self.charge_ah = 0.0
+        self.energy_wh = 0.0
+        self.error = None
+        self.resumed = False
+        self._last = None
+        self._files = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        if not self.running:
+            self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def _checkpoint_path(self):
+        return os.path.join(self.directory, 'checkpoint.json')
+
+    def _column_path(self, column):
+        return os.path.join(self.directory, column + '.f8')
+
+    # Resume from the checkpoint in 'directory', or start the discharge
+    def start(self):
+        if self.running:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(self._checkpoint_path):
+            self._resume()
+        else:
+            for column in self.columns:
+                open(self._column_path(column), 'wb').close()
+            self._battery.on()
+        self._files = {column: open(self._column_path(column), 'ab')
+                       for column in self.columns}
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='DischargeSession', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    # Drop samples written after the checkpoint, they may be partial
+    def _resume(self):
+        with open(self._checkpoint_path) as file:
+            checkpoint = json.load(file)
+        self.count = checkpoint['count']
+        self.charge_ah = checkpoint['charge_ah']
+        self.energy_wh = checkpoint['energy_wh']
+        self._last = checkpoint['last']
+        for column in self.columns:
+            with open(self._column_path(column), 'r+b') as file:
+                file.truncate(self.count * 8)
+        self.resumed = True
+
+    def _checkpoint(self):
+        for file in self._files.values():
+            file.flush()
+            os.fsync(file.fileno())
+        path = self._checkpoint_path + '.tmp'
+        with open(path, 'w') as file:
+            json.dump({'count': self.count,
+                       'charge_ah': self.charge_ah,
+                       'energy_wh': self.energy_wh,
+                       'last': self._last,
+                       'interval': self.interval}, file)
+        os.replace(path, self._checkpoint_path)
+
+    def _run(self):
+        try:
+            pending = []
+            while not self._stop.is_set():
+                sample, input_on = self.sample()
+                pending.append(sample)
+                if len(pending) >= self.checkpoint_every or not input_on:
+                    self._append(pending)
+                    pending = []
+                if not input_on:
+                    break
+                self._stop.wait(self.interval)
+            self._append(pending)
+        except Exception as error:
+            self.error = error
+        finally:
+            for file in self._files.values():
+                file.close()
+
+    # One (time, voltage, current, capacity, timer) sample and input state
+    def sample(self):
+        values = self._bus.query_values(self._query)
+        return [time.time()] + values[:4].tolist(), bool(values[4])
+
+    # Write samples to the column files, integrate them and checkpoint
+    def _append(self, samples):
+        if not samples:
+            return
+        block = np.array(samples, dtype='f8')
+        for index, column in enumerate(self.columns):
+            self._files[column].write(block[:, index].tobytes())
+        if self._last is not None:
+            block = np.vstack([self._last, block])
+        times, voltage, current = block[:, 0], block[:, 1], block[:, 2]
+        seconds = np.diff(times)
+        self.charge_ah += float(
+            np.sum((current[1:] + current[:-1]) * seconds)) / 2.0 / 3600.0
+        power = voltage * current
+        self.energy_wh += float(
+            np.sum((power[1:] + power[:-1]) * seconds)) / 2.0 / 3600.0
+        self._last = block[-1].tolist()
+        self.count += len(samples)
+        self._checkpoint()
+
+    # All logged samples as a structured array, one field per column
+    def read(self):
+        columns = [np.fromfile(self._column_path(column), dtype='f8')
+                   for column in self.columns]
+        rows = min(len(column) for column in columns)
+        data = np.zeros(rows, dtype=[(column, 'f8')
+                                     for column in self.columns])
+        for column, values in zip(self.columns, columns):
+            data[column] = values[:rows]
+        return data
+
+
+class ModeProtectionTest(Input):
+    # OCP and OPP tests: the load ramps its current (power) until the
+    # supply under test trips, seen as its voltage falling below the
+    # protection voltage. Subclasses set the SCPI root and static mode
+    root = None
+    level_header = None
+    static_mode = None
+    level_validator = None
+    samples_dtype = np.dtype([('time', 'f8'), ('voltage', 'f8'),
+                              ('current', 'f8'), ('power', 'f8')])
+    probes_dtype = np.dtype([('level', 'f8'), ('voltage', 'f8'),
+                             ('current', 'f8'), ('tripped', '?')])
+
+    # Test settings needed by run() and search(), read in one query
+    def _test_settings(self):
+        names = ('start', 'step', 'end', 'delay', 'min', 'max', 'voltage')
+        headers = (':STAR?', ':STEP?', ':END?', ':STEP:DEL?', ':MIN?',
+                   ':MAX?', ':VOLT?')
+        responses = self._bus.query_many(
+            [self.root + header for header in headers])
+        return dict(zip(names, (float(value) for value in responses)))
+
+    # Voltage and current readings, optionally followed by more commands
+    # in the same message
+    def _measure(self, *commands):
+        message = Bus.join(('MEAS:VOLT?', 'MEAS:CURR?') + commands)
+        return self._bus.query_values(message)
+
+    # Run the load's own test: arm it, turn the input on (*OPC? only
+    # acknowledges the command, the ramp is not waited for) and follow the
+    # ramp by polling voltage and current every 'interval' seconds until
+    # the supply trips or the ramp is over ('timeout' defaults to the ramp
+    # time plus margin). The bus lock is only held for each poll, so other
+    # threads can use the device during the ramp, and the input is turned
+    # off even when a poll fails. Returns {'tripped', 'level' (the highest
+    # current or power measured before the trip), 'passed' (level within
+    # min..max), 'min', 'max', 'samples'}. Not meant for Device.batch()
+    def run(self, interval=0.01, timeout=None):
+        config = self._test_settings()
+        if timeout is None:
+            steps = abs(config['end'] - config['start']) / config['step'] \
+                if config['step'] > 0 else 0.0
+            timeout = (steps + 1) * config['delay'] * 1.5 + 1.0
+        quantity = 'current' if self.static_mode == 'CURR' else 'power'
+        samples = []
+        tripped = False
+        try:
+            self.enable()
+            self._bus.query(Bus.join([':INP ON', '*OPC?']))
+            start = time.perf_counter()
+            while time.perf_counter() - start < timeout:
+                voltage, current = self._measure()[:2]
+                samples.append((time.perf_counter() - start, voltage,
+                                current, voltage * current))
+                if voltage < config['voltage']:
+                    tripped = True
+                    break
+                if interval > 0:
+                    time.sleep(interval)
+        finally:
+            self.input_control('OFF')
+        samples = np.array(samples, dtype=self.samples_dtype)
+        held = samples[samples['voltage'] >= config['voltage']]
+        level = float(held[quantity].max()) if tripped and len(held) \
+            else float('nan')
+        return {'tripped': tripped,
+                'level': level,
+                'passed': tripped and config['min'] <= level <= config['max'],
+                'min': config['min'],
+                'max': config['max'],
+                'samples': samples}
+
+    # Host side bisection for the trip level between 'low' and 'high'
+    # current (power) in the static mode, to within 'resolution'. Each
+    # probe turns the input on at one level for 'settle' seconds, costing
+    # two round trips, and 'reset' is called after a trip to restore the
+    # supply. Afterwards, also when a probe or 'reset' fails, the input is
+    # off, the static level is the one it had before and the test function
+    # is enabled again if it was. Returns {'tripped', 'level' (lowest
+    # tripping level found), 'passed' (against the test min..max),
+    # 'probes'}
+    def search(self, low, high, resolution=0.01, settle=0.05, reset=None):
+        rule = self._validate.rule(self.level_validator)
+        checked = rule.check_many([low, high])
+        if isinstance(checked, (ValueError, TypeError)):
+            print(self._command.error_text('WARNING', checked))
+            return None
+        low, high = float(low), float(high)
+        config = self._test_settings()
+        probes = []
+
+        def probe(level):
+            self._bus.write(Bus.join([
+                self.level_header + ' ' + rule.check(level), ':INP ON']))
+            time.sleep(settle)
+            voltage, current = self._measure(':INP OFF')[:2]
+            tripped = bool(voltage < config['voltage'])
+            probes.append((level, voltage, current, tripped))
+            if tripped and reset is not None:
+                reset()
+            return tripped
+
+        with self._bus.lock:
+            previous, enabled = self._bus.query_values(Bus.join(
+                [self.level_header + '?', self.root + ':FUNC?']))[:2]
+            try:
+                self._bus.write(':FUNC ' + self.static_mode)
+                self._set_mode_name('STATIC', Mode(self.static_mode))
+                tripped = probe(high)
+                if not tripped:
+                    level = float('nan')
+                elif probe(low):
+                    level = low
+                else:
+                    while high - low > resolution:
+                        middle = round((low + high) / 2.0, 6)
+                        if probe(middle):
+                            high = middle
+                        else:
+                            low = middle
+                    level = high
+            finally:
+                self.input_control('OFF')
+                self._bus.write(
+                    self.level_header + ' ' + rule.check(previous))
+                if enabled:
+                    self.enable()
+        return {'tripped': tripped,
+                'level': level,
+                'passed': tripped and config['min'] <= level <= config['max'],
+                'probes': np.array(probes, dtype=self.probes_dtype)}
+
+
+class ModeOCP(ModeProtectionTest):
+    root = ':OCP'
+    level_header = ':CURR'
+    static_mode = 'CURR'
+    level_validator = 'current'
+    settings = ('current_range', 'voltage_range', 'start_current',
+                'step_current', 'end_current', 'min_current', 'max_current',
+                'voltage_limit', 'step_delay')
 
-class ModeOCP(Input):
     def __init__(self, bus):
         self._bus = bus
         Input.__init__(self, bus)
         self._validate = ValidateTest(self._bus)
         self._mode_ocp = {}
-        self._mode_ocp = {
+
+    def _read_values(self):
+        self._mode_ocp.update({
             'enable': self.get_enable(),
             'start_current': self.start_current(),
             'step_current': self.step_current(),
@@ -1249,10 +2669,8 @@ class ModeOCP(Input):
             'voltage_limit': self.voltage_limit(),
             'step_delay': self.step_delay(),
             'current_range': self.current_range(),
-            'voltage_range': self.voltage_range()}
-        self.values = {
-            'input': global_input_values,
-            'mode': self._mode_ocp}
+            'voltage_range': self.voltage_range()})
+        return self._mode_ocp
 
     def on(self):
         self.enable()
@@ -1260,7 +2678,7 @@ class ModeOCP(Input):
 
     def enable(self):
         write = ':OCP:FUNC'
-        self.values['input']['mode'] = 'OCP'
+        self._bus.input_values['mode'] = 'OCP'
         self._command.write(write)
 
     def get_enable(self):
@@ -1310,8 +2728,8 @@ class ModeOCP(Input):
             set_protection_voltage, self._mode_ocp, 'voltage_limit')
 
     def step_delay(self, set_step_delay_time=None):
-        query = ':OCP:STEP?'
-        write = ':OCP:STEP'
+        query = ':OCP:STEP:DEL?'
+        write = ':OCP:STEP:DEL'
         return self._command.read_write(
             query, write, self._validate.step_time,
             set_step_delay_time, self._mode_ocp, 'step_delay')
@@ -1331,13 +2749,23 @@ class ModeOCP(Input):
             set_voltage_range, self._mode_ocp, 'voltage_range')
 
 
-class ModeOPP(Input):
+class ModeOPP(ModeProtectionTest):
+    root = ':OPP'
+    level_header = ':POW'
+    static_mode = 'POW'
+    level_validator = 'power'
+    settings = ('current_range', 'voltage_range', 'start_power',
+                'step_power', 'end_power', 'min_power', 'max_power',
+                'voltage_limit', 'step_delay')
+
     def __init__(self, bus):
         self._bus = bus
         Input.__init__(self, bus)
         self._validate = ValidateTest(self._bus)
         self._mode_opp = {}
-        self._mode_opp = {
+
+    def _read_values(self):
+        self._mode_opp.update({
             'enable': self.get_enable(),
             'start_power': self.start_power(),
             'step_power': self.step_power(),
@@ -1347,10 +2775,8 @@ class ModeOPP(Input):
             'voltage_limit': self.voltage_limit(),
             'step_delay': self.step_delay(),
             'current_range': self.current_range(),
-            'voltage_range': self.voltage_range()}
-        self.values = {
-            'input': global_input_values,
-            'mode': self._mode_opp}
+            'voltage_range': self.voltage_range()})
+        return self._mode_opp
 
     def on(self):
         self.enable()
@@ -1358,7 +2784,7 @@ class ModeOPP(Input):
 
     def enable(self):
         write = ':OPP:FUNC'
-        self.values['input']['mode'] = 'OCP'
+        self._bus.input_values['mode'] = 'OPP'
         self._command.write(write)
 
     def get_enable(self):
@@ -1408,34 +2834,41 @@ class ModeOPP(Input):
             set_protection_voltage, self._mode_opp, 'voltage_limit')
 
     def step_delay(self, set_step_delay_time=None):
-        query = ':OPP:STEP?'
-        write = ':OPP:STEP'
+        query = ':OPP:STEP:DEL?'
+        write = ':OPP:STEP:DEL'
         return self._command.read_write(
             query, write, self._validate.step_time,
             set_step_delay_time, self._mode_opp, 'step_delay')
 
     def current_range(self, set_current_range=None):
-        query = ':OCP:IRANG?'
-        write = ':OCP:IRANG'
+        query = ':OPP:IRANG?'
+        write = ':OPP:IRANG'
         return self._command.read_write(
             query, write, self._validate.current_range,
             set_current_range, self._mode_opp, 'current_range')
 
     def voltage_range(self, set_voltage_range=None):
-        query = ':OCP:VRANG?'
-        write = ':OCP:VRANG'
+        query = ':OPP:VRANG?'
+        write = ':OPP:VRANG'
         return self._command.read_write(
             query, write, self._validate.voltage_range,
             set_voltage_range, self._mode_opp, 'voltage_range')
 
 
 class ModeProgram(Input):
+    settings = ('step',)
+
     def __init__(self, bus):
         self._bus = bus
         Input.__init__(self, bus)
         self._validate = ValidateTest(self._bus)
         self._mode_prog = {}
-        self._mode_prog = {
+        # Program table from the last download() or upload()
+        self._table = None
+        self._table_generation = bus.generation
+
+    def _read_values(self):
+        self._mode_prog.update({
             'enable': self.get_enable(),
             'step_mode': self.step_mode(),
             'step': self.step(),
@@ -1452,10 +2885,8 @@ class ModeProgram(Input):
             'min': self.min(),
             'test': self.test(),
             'led_current': self.led_current(),
-            'led_rco_set': self.led_rco_set()}
-        self.values = {
-            'input': global_input_values,
-            'mode': self._mode_prog}
+            'led_rco_set': self.led_rco_set()})
+        return self._mode_prog
 
     def on(self):
         self.enable()
@@ -1464,7 +2895,7 @@ class ModeProgram(Input):
     def enable(self):
         write = ':PROG:STAT:ON'
         self._command.write(write)
-        self.values['input']['mode'] = 'Program'
+        self._bus.input_values['mode'] = 'Program'
 
     def get_enable(self):
         query = ':PROG:STAT?'
@@ -1474,6 +2905,8 @@ class ModeProgram(Input):
         query = ':PROG:MODE? ' + str(step)
         write = ':PROG:MODE ' + str(step) + ','
         self._validate.step_range(step)
+        if set_program_mode is not None:
+            self._table = None
         return self._command.read_write(
             query, write, self._validate.mode_static,
             set_program_mode, self._mode_prog, 'program_mode')
@@ -1481,6 +2914,8 @@ class ModeProgram(Input):
     def step(self, set_steps=None):
         query = ':PROG:STEP?'
         write = ':PROG:STEP'
+        if set_steps is not None:
+            self._table = None
         return self._command.read_write(
             query, write, self._validate.step_range,
             set_steps, self._mode_prog, 'step')
@@ -1489,14 +2924,19 @@ class ModeProgram(Input):
         query = ':PROG:LEV? ' + str(step)
         write = ':PROG:LEV ' + str(step) + ','
         self._validate.step_range(step)
+        if set_level is not None:
+            self._table = None
         return self._command.read_write(
-            query, write, self._validate.program_levels,
+            query, write,
+            lambda value: self._validate.program_levels(value, step),
             set_level, self._mode_prog, 'level')
 
     def current_range(self, step=1, set_current_range=None):
         query = ':PROG:IRANG? ' + str(step)
         write = ':PROG:IRANG ' + str(step) + ','
         self._validate.step_range(step)
+        if set_current_range is not None:
+            self._table = None
         return self._command.read_write(
             query, write, self._validate.current_range,
             set_current_range, self._mode_prog, 'current_range')
@@ -1505,6 +2945,8 @@ class ModeProgram(Input):
         query = ':PROG:VRANG? ' + str(step)
         write = ':PROG:VRANG ' + str(step) + ','
         self._validate.step_range(step)
+        if set_voltage_range is not None:
+            self._table = None
         return self._command.read_write(
             query, write, self._validate.voltage_range,
             set_voltage_range, self._mode_prog, 'voltage_range')
@@ -1513,6 +2955,8 @@ class ModeProgram(Input):
         query = ':PROG:RRANG? ' + str(step)
         write = ':PROG:RRANG ' + str(step) + ','
         self._validate.step_range(step)
+        if set_resistance_range is not None:
+            self._table = None
         return self._command.read_write(
             query, write, self._validate.resistance_range,
             set_resistance_range, self._mode_prog, 'resistance_range')
@@ -1521,6 +2965,8 @@ class ModeProgram(Input):
         query = ':PROG:SHOR? ' + str(step)
         write = ':PROG:SHOR ' + str(step) + ','
         self._validate.step_range(step)
+        if set_step_short is not None:
+            self._table = None
         return self._command.read_write(
             query, write, self._validate.on_off,
             set_step_short, self._mode_prog, 'step_short')
@@ -1529,6 +2975,8 @@ class ModeProgram(Input):
         query = ':PROG:PAUSE? ' + str(step)
         write = ':PROG:PAUSE ' + str(step) + ','
         self._validate.step_range(step)
+        if set_step is not None:
+            self._table = None
         return self._command.read_write(
             query, write, self._validate.on_off,
             set_step, self._mode_prog, 'pause')
@@ -1537,6 +2985,8 @@ class ModeProgram(Input):
         query = ':PROG:TIME:ON? ' + str(step)
         write = ':PROG:TIME:ON ' + str(step) + ','
         self._validate.step_range(step)
+        if set_start_current is not None:
+            self._table = None
         return self._command.read_write(
             query, write, self._validate.step_time,
             set_start_current, self._mode_prog, 'time_on')
@@ -1545,6 +2995,8 @@ class ModeProgram(Input):
         query = ':PROG:TIME:OFF? ' + str(step)
         write = ':PROG:TIME:OFF ' + str(step) + ','
         self._validate.step_range(step)
+        if set_start_current is not None:
+            self._table = None
         return self._command.read_write(
             query, write, self._validate.step_time,
             set_start_current, self._mode_prog, 'time_off')
@@ -1553,6 +3005,8 @@ class ModeProgram(Input):
         query = ':PROG:TIME:DEL? ' + str(step)
         write = ':PROG:TIME:DEL ' + str(step) + ','
         self._validate.step_range(step)
+        if set_step_current is not None:
+            self._table = None
         return self._command.read_write(
             query, write, self._validate.step_time,
             set_step_current, self._mode_prog, 'time_delay')
@@ -1561,22 +3015,30 @@ class ModeProgram(Input):
         query = ':PROG:MAX? ' + str(step)
         write = ':PROG:MAX ' + str(step) + ','
         self._validate.step_range(step)
+        if set_end_current is not None:
+            self._table = None
         return self._command.read_write(
-            query, write, self._validate.step_min_max,
+            query, write,
+            lambda value: self._validate.step_min_max(value, step),
             set_end_current, self._mode_prog, 'max')
 
     def min(self, step=1, set_min_current=None):
         query = ':PROG:MIN? ' + str(step)
         write = ':PROG:MIN ' + str(step) + ','
         self._validate.step_range(step)
+        if set_min_current is not None:
+            self._table = None
         return self._command.read_write(
-            query, write, self._validate.step_min_max,
+            query, write,
+            lambda value: self._validate.step_min_max(value, step),
             set_min_current, self._mode_prog, 'min')
 
     def led_current(self, step=1, set_max_current=None):
         query = ':PROG:LED:CURR? ' + str(step)
         write = ':PROG:LED:CURR ' + str(step) + ','
         self._validate.step_range(step)
+        if set_max_current is not None:
+            self._table = None
         return self._command.read_write(
             query, write, self._validate.current,
             set_max_current, self._mode_prog, 'led_current')
@@ -1585,6 +3047,8 @@ class ModeProgram(Input):
         query = ':PROG:LED:RCO? ' + str(step)
         write = ':PROG:LED:RCO ' + str(step) + ','
         self._validate.step_range(step)
+        if set_step_led_rco_set is not None:
+            self._table = None
         return self._command.read_write(
             query, write, self._validate.led_rco,
             set_step_led_rco_set, self._mode_prog, 'led_rco_set')
@@ -1597,27 +3061,403 @@ class ModeProgram(Input):
             query, write, self._validate.step_time,
             set_step_test, self._mode_prog, 'test')
 
+    ###################
+    # Program tables  #
+    ###################
+
+    # Per-step program settings: table column, SCPI header, dtype, rule
+    step_fields = (
+        ('step_mode', ':PROG:MODE', 'U10', 'mode_static'),
+        ('level', ':PROG:LEV', 'f8', None),
+        ('current_range', ':PROG:IRANG', 'i4', 'current_range'),
+        ('voltage_range', ':PROG:VRANG', 'i4', 'voltage_range'),
+        ('resistance_range', ':PROG:RRANG', 'U10', 'resistance_range'),
+        ('step_short', ':PROG:SHOR', 'i4', 'on_off'),
+        ('pause', ':PROG:PAUSE', 'i4', 'on_off'),
+        ('time_on', ':PROG:TIME:ON', 'f8', 'step_time'),
+        ('time_off', ':PROG:TIME:OFF', 'f8', 'step_time'),
+        ('time_delay', ':PROG:TIME:DEL', 'f8', 'step_time'),
+        ('max', ':PROG:MAX', 'f8', None),
+        ('min', ':PROG:MIN', 'f8', None),
+        ('led_current', ':PROG:LED:CURR', 'f8', 'current'),
+        ('led_rco_set', ':PROG:LED:RCO', 'f8', 'led_rco'))
+    step_dtype = np.dtype(
+        [(name, dtype) for name, _, dtype, _ in step_fields])
+
+    # Empty program table of 'steps' rows, one column per step setting
+    def table(self, steps):
+        return np.zeros(steps, dtype=self.step_dtype)
+
+    # Read every setting of every step (all steps when 'steps' is None)
+    # with query_many(), MAX_MESSAGE_COMMANDS queries per message (10
+    # steps take 6 round trips), returning the program table
+    def download(self, steps=None):
+        if steps is None:
+            steps = int(self._command.read(':PROG:STEP?'))
+        queries = ['{}? {}'.format(header, step)
+                   for step in range(1, steps + 1)
+                   for _, header, _, _ in self.step_fields]
+        responses = self._bus.query_many(queries)
+        table = self.table(steps)
+        width = len(self.step_fields)
+        for row in range(steps):
+            for column, (name, header, dtype, _) in enumerate(
+                    self.step_fields):
+                response = responses[row * width + column]
+                table[name][row] = self._parse_cell(dtype, response)
+                if name == 'step_mode':
+                    self._bus.set_mode(
+                        '{}? {}'.format(header, row + 1), response)
+        self._known(table)
+        return table.copy()
+
+    # Send a program table, writing only the cells that differ from the
+    # last download() or upload() (everything when 'force' is set or the
+    # load may have changed since), then read the written cells back in
+    # one bulk query. Returns the steps whose read-back differs
+    def upload(self, table, force=False):
+        known = self._table
+        if force or self._table_generation != self._bus.generation:
+            known = None
+        steps = len(table)
+        if known is not None and len(known) != steps:
+            known = None
+        changed = {}
+        for name, _, dtype, _ in self.step_fields:
+            if known is None:
+                changed[name] = list(range(steps))
+            else:
+                changed[name] = np.flatnonzero(~self._same_cells(
+                    dtype, table[name], known[name])).tolist()
+        # Only the cells being written are validated
+        checked = self._check_table(table, changed)
+        if isinstance(checked, (ValueError, TypeError)):
+            print(self._command.error_text('WARNING', checked))
+            return None
+        # (row, column, command, read-back query), row None for the count
+        writes = []
+        if known is None:
+            writes.append((None, None, ':PROG:STEP ' + str(steps),
+                           ':PROG:STEP?'))
+        for name, header, _, _ in self.step_fields:
+            for row in changed[name]:
+                step = str(row + 1)
+                writes.append((
+                    row, name,
+                    header + ' ' + step + ',' + checked[name][row],
+                    header + '? ' + step))
+
+        with self._bus.lock:
+            with self._bus.batch():
+                for _, _, command, _ in writes:
+                    self._bus.write(command)
+            responses = self._bus.query_many(
+                [query for _, _, _, query in writes])
+
+        result = table.copy() if known is None else known.copy()
+        dtypes = {name: dtype for name, _, dtype, _ in self.step_fields}
+        mismatched = []
+        for (row, name, _, query), response in zip(writes, responses):
+            if row is None:
+                continue
+            cell = self._parse_cell(dtypes[name], response)
+            result[name][row] = cell
+            if name == 'step_mode':
+                self._bus.set_mode(query, response)
+            same = self._same_cells(
+                dtypes[name], np.array([cell]), table[name][row:row + 1])
+            if not same[0] and row + 1 not in mismatched:
+                mismatched.append(row + 1)
+        self._known(result)
+        mismatched.sort()
+        if mismatched:
+            print(self._command.error_text('WARNING', ValueError(
+                'ValueError!\nRead-back differs for program steps {}'
+                .format(mismatched))))
+        return mismatched
+
+    # ':PROG:TEST?' result of every step, read with one bulk query
+    def results(self, steps=None):
+        if steps is None:
+            steps = int(self._command.read(':PROG:STEP?'))
+        responses = self._bus.query_many(
+            [':PROG:TEST? ' + str(step) for step in range(1, steps + 1)])
+        return np.array([self._parse_cell('i4', response)
+                         for response in responses], dtype=int)
+
+    def _known(self, table):
+        self._table = table.copy()
+        self._table_generation = self._bus.generation
+
+    # Validate the given rows of each column, returning {column: {row:
+    # string to send}}, level/min/max checked against each step's mode
+    def _check_table(self, table, rows):
+        checked = {}
+        modes = table['step_mode'].tolist()
+        for name, _, _, rule in self.step_fields:
+            values = table[name].tolist()
+            if rule is not None:
+                groups = [(self._validate.rules[rule], rows[name])]
+            else:
+                groups = []
+                for mode in set(modes[row] for row in rows[name]):
+                    if name == 'level':
+                        step_rule = self._validate.level_rule(mode)
+                    else:
+                        step_rule = self._validate.min_max_rule(mode)
+                    groups.append((step_rule, [
+                        row for row in rows[name] if modes[row] == mode]))
+            checked[name] = {}
+            for step_rule, group in groups:
+                val = step_rule.check_many([values[row] for row in group])
+                if isinstance(val, (ValueError, TypeError)):
+                    return val
+                checked[name].update(zip(group, val))
+        return checked
+
+    @staticmethod
+    def _parse_cell(dtype, response):
+        if isinstance(response, (bool, int, float)):
+            return int(response) if dtype.startswith('i') else response
+        response = str(response).strip()
+        if dtype.startswith('U'):
+            return response.upper()
+        try:
+            value = float(response)
+        except ValueError:
+            return 1 if response.upper() == 'ON' else 0
+        return int(value) if dtype.startswith('i') else value
+
+    # Cell-wise equality; keywords match when one is a prefix of the other
+    # so 'CURR' and 'CURRENT' are the same setting
+    @staticmethod
+    def _same_cells(dtype, new, old):
+        if dtype.startswith('U'):
+            new = np.char.upper(new)
+            return np.char.startswith(new, old) | \
+                np.char.startswith(old, new)
+        if dtype.startswith('f'):
+            return np.isclose(new, old, rtol=1e-6, atol=1e-9)
+        return new == old
+
 
 class ModeTime(Input):
-    pass
+    settings = ('state', 'voltage_low', 'voltage_high')
+    results_dtype = np.dtype([('rise', 'f8'), ('fall', 'f8'),
+                              ('stale', '?')])
+    # Both results of a measurement, read in one message
+    _query = ':TIME:TEST:RISE?;:TIME:TEST:FALL?'
+
+    def __init__(self, bus):
+        self._bus = bus
+        Input.__init__(self, bus)
+        self._validate = ValidateTest(self._bus)
+        self._mode_time = {}
+
+    def _read_values(self):
+        self._mode_time.update({
+            'state': self.state(),
+            'voltage_low': self.voltage_low(),
+            'voltage_high': self.voltage_high(),
+            'rise': self.rise(),
+            'fall': self.fall()})
+        return self._mode_time
+
+    def state(self, set_state=None):
+        query = ':TIME:TEST?'
+        write = ':TIME:TEST'
+        return self._command.read_write(
+            query, write, self._validate.on_off,
+            set_state, self._mode_time, 'state')
+
+    # The rise time runs from voltage_low to voltage_high, the fall time
+    # from voltage_high back down to voltage_low
+    def voltage_low(self, set_voltage_low=None):
+        query = ':TIME:TEST:VOLT:LOW?'
+        write = ':TIME:TEST:VOLT:LOW'
+        return self._command.read_write(
+            query, write, self._validate.voltage,
+            set_voltage_low, self._mode_time, 'voltage_low')
+
+    def voltage_high(self, set_voltage_high=None):
+        query = ':TIME:TEST:VOLT:HIGH?'
+        write = ':TIME:TEST:VOLT:HIGH'
+        return self._command.read_write(
+            query, write, self._validate.voltage,
+            set_voltage_high, self._mode_time, 'voltage_high')
+
+    def rise(self):
+        query = ':TIME:TEST:RISE?'
+        return self._command.read(query)
+
+    def fall(self):
+        query = ':TIME:TEST:FALL?'
+        return self._command.read(query)
+
+    # Repeat the rise/fall measurement 'count' times with the time test
+    # on, reading both results in one round trip per measurement. 'cycle'
+    # is called before each one to produce a new edge, e.g. a function
+    # switching the supply under test off and on, and 'interval' seconds
+    # are waited after it. The bus lock is not held while 'cycle' runs, so
+    # it may use this device from any thread. The load keeps reporting the
+    # last times until it sees a new edge: a result identical to the one
+    # before is marked stale and left out of the statistics. The previous
+    # time test state is restored afterwards. Returns {'rise', 'fall'}
+    # statistics (see statistics()), 'stale', the number of stale results,
+    # and 'samples', a results_dtype array. Not meant for Device.batch()
+    #   dev.test.time.capture(1000, cycle=toggle_supply)['rise']['p99']
+    def capture(self, count, cycle=None, interval=0.0,
+                percentiles=(5, 50, 95, 99)):
+        if isinstance(count, bool) or not isinstance(
+                count, (int, np.integer)) or count < 1:
+            print(self._command.error_text('WARNING', ValueError(
+                'ValueError!\ncount must be a positive integer')))
+            return None
+        values = np.empty((int(count), 2))
+        previous = self._bus.query_values(':TIME:TEST?')[0]
+        try:
+            self.state('ON')
+            for i in range(int(count)):
+                if cycle is not None:
+                    cycle()
+                if interval > 0:
+                    time.sleep(interval)
+                values[i] = self._bus.query_values(self._query)[:2]
+        finally:
+            if not previous:
+                self.state('OFF')
+        stale = np.zeros(len(values), dtype=bool)
+        stale[1:] = (values[1:] == values[:-1]).all(axis=1)
+        stats = self.statistics(
+            np.where(stale[:, np.newaxis], np.nan, values), percentiles)
+        samples = np.empty(len(values), dtype=self.results_dtype)
+        samples['rise'] = values[:, 0]
+        samples['fall'] = values[:, 1]
+        samples['stale'] = stale
+        return {'rise': stats[0], 'fall': stats[1],
+                'stale': int(stale.sum()), 'samples': samples}
+
+    # Column statistics of a 2D array, computed for all columns at once:
+    # one {'count', 'mean', 'std', 'min', 'max', 'p<percentile>', ...}
+    # per column, ignoring NaN readings
+    @staticmethod
+    def statistics(values, percentiles=(5, 50, 95, 99)):
+        values = np.asarray(values, dtype=float)
+        if values.ndim == 1:
+            values = values[:, np.newaxis]
+        columns = {
+            'count': np.count_nonzero(~np.isnan(values), axis=0),
+            'mean': np.nanmean(values, axis=0),
+            'std': np.nanstd(values, axis=0),
+            'min': np.nanmin(values, axis=0),
+            'max': np.nanmax(values, axis=0)}
+        if len(percentiles):
+            points = np.nanpercentile(values, percentiles, axis=0)
+            for percentile, point in zip(percentiles, points):
+                columns['p{:g}'.format(percentile)] = point
+        return [{name: column[i].item() for name, column in columns.items()}
+                for i in range(values.shape[1])]
 
 
 class Protection:
-    pass
+    # Current and power protection of the input: once the level is exceeded
+    # for 'delay' seconds with the state on, the load turns its input off.
+    # Levels and delays come before the states, the order apply() uses
+    settings = ('current_level', 'current_delay', 'current_state',
+                'power_level', 'power_delay', 'power_state')
+
+    def __init__(self, bus):
+        self._bus = bus
+        self._validate = ValidateInput(self._bus)
+        self._command = Command(self._bus)
+        self._protection = {}
+        self._values = None
+
+    @property
+    def values(self):
+        if self._values is None:
+            self._values = {
+                'input': self._bus.input_values,
+                'mode': self._read_values()}
+            for values in self._values.values():
+                BatchResult.resolve(values)
+        return self._values
+
+    def _read_values(self):
+        self._protection.update({
+            name: getattr(self, name)() for name in self.settings})
+        return self._protection
+
+    def current_state(self, set_on_off=None):
+        query = ':CURR:PROT:STAT?'
+        write = ':CURR:PROT:STAT'
+        return self._command.read_write(
+            query, write, self._validate.on_off,
+            set_on_off, self._protection, 'current_state')
+
+    def current_level(self, set_current=None):
+        query = ':CURR:PROT:LEV?'
+        write = ':CURR:PROT:LEV'
+        return self._command.read_write(
+            query, write, self._validate.current,
+            set_current, self._protection, 'current_level')
+
+    def current_delay(self, set_delay=None):
+        query = ':CURR:PROT:DEL?'
+        write = ':CURR:PROT:DEL'
+        return self._command.read_write(
+            query, write, self._validate.protection_delay,
+            set_delay, self._protection, 'current_delay')
+
+    def power_state(self, set_on_off=None):
+        query = ':POW:PROT:STAT?'
+        write = ':POW:PROT:STAT'
+        return self._command.read_write(
+            query, write, self._validate.on_off,
+            set_on_off, self._protection, 'power_state')
+
+    def power_level(self, set_power=None):
+        query = ':POW:PROT:LEV?'
+        write = ':POW:PROT:LEV'
+        return self._command.read_write(
+            query, write, self._validate.power,
+            set_power, self._protection, 'power_level')
+
+    def power_delay(self, set_delay=None):
+        query = ':POW:PROT:DEL?'
+        write = ':POW:PROT:DEL'
+        return self._command.read_write(
+            query, write, self._validate.protection_delay,
+            set_delay, self._protection, 'power_delay')
 
 
 class System:
+    settings = ('external_sense', 'imonitor', 'vmonitor', 'stop_on_fail',
+                'trigger_source')
+
     def __init__(self, bus):
         self._bus = bus
         self._validate = ValidateTest(self._bus)
         self._command = Command(self._bus)
         self._system = {}
-        self._system = {
+        self._values = None
+
+    @property
+    def values(self):
+        if self._values is None:
+            self._values = {
+                'input': self._bus.input_values,
+                'mode': self._read_values()}
+            for values in self._values.values():
+                BatchResult.resolve(values)
+        return self._values
+
+    def _read_values(self):
+        self._system.update({
             'external_sense': self.get_sense_state(),
-            'stop_on_fail': self.get_stop_on_fail_state()}
-        self.values = {
-            'input': global_input_values,
-            'mode': self._system}
+            'stop_on_fail': self.get_stop_on_fail_state(),
+            'trigger_source': self.trigger_source()})
+        return self._system
 
     def external_sense_on(self):
         write = ':SYST:SENS ON'
@@ -1667,367 +3507,398 @@ class System:
         query = ':STOP:ON:FAIL?'
         return self._command.read(query)
 
+    def external_sense(self, set_on_off=None):
+        query = ':SYST:SENS?'
+        write = ':SYST:SENS'
+        return self._command.read_write(
+            query, write, self._validate.on_off,
+            set_on_off, self._system, 'external_sense')
 
-class Validate:
+    def imonitor(self, set_on_off=None):
+        query = ':SYST:IMONI?'
+        write = ':SYST:IMONI'
+        return self._command.read_write(
+            query, write, self._validate.on_off,
+            set_on_off, self._system, 'imonitor')
+
+    def vmonitor(self, set_on_off=None):
+        query = ':SYST:VMONI?'
+        write = ':SYST:VMONI'
+        return self._command.read_write(
+            query, write, self._validate.on_off,
+            set_on_off, self._system, 'vmonitor')
+
+    def stop_on_fail(self, set_on_off=None):
+        query = ':STOP:ON:FAIL?'
+        write = ':STOP:ON:FAIL'
+        return self._command.read_write(
+            query, write, self._validate.on_off,
+            set_on_off, self._system, 'stop_on_fail')
+
+    # What starts a transient or test step: the front panel Trigger key
+    # (MANUal), the rear panel trigger input (EXTernal) or *TRG (BUS)
+    def trigger_source(self, set_source=None):
+        query = ':TRIG:SOUR?'
+        write = ':TRIG:SOUR'
+        return self._command.read_write(
+            query, write, self._validate.trigger_source,
+            set_source, self._system, 'trigger_source')
+
+
+# Escape sequences used by Validate.error_text()
+ANSI_ESCAPES = {'HEADER': '\033[95m',
+                'OKBLUE': '\033[94m',
+                'OKGREEN': '\033[92m',
+                'WARNING': '\033[93m',
+                'FAIL': '\033[91m',
+                'ENDC': '\033[0m',
+                'BOLD': '\033[1m',
+                'UNDERLINE': '\033[4m'
+                }
+
+
+# Short form of a SCPI keyword: its upper case part, 'MINimum' -> 'MIN'
+def keyword_short(keyword):
+    short = ''.join(c for c in keyword if not c.islower())
+    return short or keyword
+
+
+class Rule:
+    # Validation rule for one command parameter, compiled once:
+    # numbers is a (min, max) range, or a set of values with span=False,
+    # keywords are accepted in their short or long form, any case
+    def __init__(self, numbers=None, keywords=(), integer=False,
+                 span=True, round_to=None):
+        self.numbers = numbers
+        self.keywords = keywords
+        self.integer = integer
+        self.span = span
+        self.round_to = round_to
+        self.accepted = frozenset(
+            form.lower() for keyword in keywords
+            for form in (keyword, keyword_short(keyword)))
+        if numbers is None:
+            self.types = ()
+        elif integer:
+            self.types = (int,)
+        else:
+            self.types = (float, int)
+        self._number_set = frozenset(numbers or ()) if not span else None
+        # Error texts are built here, not on every failing call
+        kind = '(int)' if integer else '(float, int)'
+        numbers_text = '{}:{} {}'.format(
+            'range' if span else 'set', kind, numbers)
+        keywords_text = 'set:(str) {}'.format(keywords)
+        self._number_error = 'ValueError!\nNot in ' + numbers_text
+        self._keyword_error = 'ValueError!\nNot in ' + keywords_text
+        if keywords and numbers is not None:
+            self._number_error += '\nor in ' + keywords_text
+            self._keyword_error += '\nor in ' + numbers_text
+        valid = self.types + ((str,) if keywords else ())
+        self._type_error = 'TypeError!\nReceived type: {}\nValid types: ' + \
+            ', '.join(str(t) for t in valid)
+
+    def _in_numbers(self, value):
+        if self.span:
+            if self.round_to is not None:
+                value = round(float(value), self.round_to)
+            return self.numbers[0] <= value <= self.numbers[1]
+        return float(value) in self._number_set
+
+    # Validated string to send, or the ValueError/TypeError to report
+    def check(self, value):
+        if isinstance(value, str) and self.keywords:
+            if value.lower() in self.accepted:
+                return value.upper()
+            return ValueError(self._keyword_error)
+        if isinstance(value, self.types):
+            if isinstance(value, bool):
+                value = int(value)
+            if self._in_numbers(value):
+                return str(value)
+            return ValueError(self._number_error)
+        return TypeError(self._type_error.format(type(value)))
+
+    # check() for a whole sequence of values, numbers tested as one array,
+    # returning the list of strings or the first error
+    def check_many(self, values):
+        if isinstance(values, np.ndarray):
+            numeric = values.dtype.kind in ('iu' if self.integer else 'iuf')
+        else:
+            values = list(values)
+            numeric = all(isinstance(value, self.types) for value in values)
+        if not (numeric and self.span and self.numbers is not None):
+            checked = [self.check(value) for value in values]
+            for value in checked:
+                if isinstance(value, (ValueError, TypeError)):
+                    return value
+            return checked
+        array = np.asarray(values, dtype=float)
+        if self.round_to is not None:
+            array = np.round(array, self.round_to)
+        inside = (array >= self.numbers[0]) & (array <= self.numbers[1])
+        if not inside.all():
+            return ValueError(self._number_error)
+        return [str(value) for value in values]
+
+
+# Rule for a validation set given as a plain tuple, used by the Validate
+# helpers below
+@lru_cache(maxsize=None)
+def compile_rule(numbers=None, keywords=(), integer=False,
+                 span=True, round_to=None):
+    return Rule(numbers, keywords, integer, span, round_to)
 
-    def float_range(self):
-        return lambda x, y: y[0] <= x <= y[1]
 
-    def int_range(self):
-        return lambda x, y: x in range(y[0], y[1] + 1)
+class Validate:
+    # Compiled rules by validator name, shared by all instances
+    rules = {}
 
-    def find_element(self):
-        return lambda x, y: x in y
+    def rule(self, name, step=1):
+        return self.rules[name]
 
     def error_text(self, warning_type, error_type):
-        ansi_esc_seq = {'HEADER': '\033[95m',
-                        'OKBLUE': '\033[94m',
-                        'OKGREEN': '\033[92m',
-                        'WARNING': '\033[93m',
-                        'FAIL': '\033[91m',
-                        'ENDC': '\033[0m',
-                        'BOLD': '\033[1m',
-                        'UNDERLINE': '\033[4m'
-                        }
-        return str(ansi_esc_seq[warning_type] + str(error_type) + ansi_esc_seq['ENDC'])
+        return str(ANSI_ESCAPES[warning_type] + str(error_type) +
+                   ANSI_ESCAPES['ENDC'])
 
     def float_rng_and_str_tuples(self, validation_set, value, round_to):
-        if isinstance(value, (float, int)):
-            val = round(float(value), round_to)
-            validator = self.float_range()
-            if validator(val, validation_set[0]):
-                return str(value)
-            else:
-                return ValueError('ValueError!\n'
-                                  'Not in range:(float, int) {}\n'
-                                  'or in set:(str) {}'.format(
-                    validation_set[0],
-                    validation_set[1]))
-        elif isinstance(value, str):
-            val = value.lower()
-            validator = self.find_element()
-            if validator(val, str(validation_set[1]).lower()):
-                return val.upper()
-            else:
-                return ValueError('ValueError!\n'
-                                  'Not in set:(str) {}\n'
-                                  'or in range:(float, int) {}'.format(
-                    validation_set[1],
-                    validation_set[0]))
-        else:
-            return TypeError('TypeError!\n'
-                             'Received type: {}\n'
-                             'Valid types: {}, {}, {}'.format(
-                type(value), int, float, str))
+        return compile_rule(validation_set[0], validation_set[1],
+                            round_to=round_to).check(value)
 
     def int_rng_and_str_tuples(self, validation_set, value):
-        if isinstance(value, int):
-            val = value
-            validator = self.int_range()
-            if validator(val, validation_set[0]):
-                return str(value)
-            else:
-                return ValueError('ValueError!\n'
-                                  'Not in range:(int) {}\n'
-                                  'or in set:(str) {}'.format(
-                    validation_set[0],
-                    validation_set[1]))
-        elif isinstance(value, str):
-            val = value.lower()
-            validator = self.find_element()
-            if validator(val, str(validation_set[1]).lower()):
-                return val.upper()
-            else:
-                return ValueError('ValueError!\n'
-                                  'Not in set:(str) {}\n'
-                                  'or in range:(int) {}'.format(
-                    validation_set[1],
-                    validation_set[0]))
-        else:
-            return TypeError('TypeError!\n'
-                             'Received type: {}\n'
-                             'Valid types: {}, {}'.format(
-                type(value), int, str))
+        return compile_rule(validation_set[0], validation_set[1],
+                            integer=True).check(value)
 
     def float_and_str_tuples(self, validation_set, value):
-        if isinstance(value, (float, int)):
-            validator = self.find_element()
-            val = float(value)
-            if validator(val, validation_set[0]):
-                return str(value)
-            else:
-                return ValueError('ValueError!\n'
-                                  'Not in set:(float, int) {}\n'
-                                  'or in set:(str) {}'.format(
-                    validation_set[0],
-                    validation_set[1]))
-        elif isinstance(value, str):
-            val = value.lower()
-            validator = self.find_element()
-            if validator(val, str(validation_set[1]).lower()):
-                return val.upper()
-            else:
-                return ValueError('ValueError!\n'
-                                  'Not in set:(str) {}\n'
-                                  'or in set:(float, str) {}'.format(
-                    validation_set[1],
-                    validation_set[0]))
-        else:
-            return TypeError('TypeError!\n'
-                             'Received type: {}\n'
-                             'Valid types: {}, {}, {}'.format(
-                type(value), int, float, str))
+        return compile_rule(validation_set[0], validation_set[1],
+                            span=False).check(value)
 
     def int_and_str_tuples(self, validation_set, value):
-        if isinstance(value, int):
-            validator = self.find_element()
-            val = float(value)
-            if validator(val, validation_set[0]):
-                return str(value)
-            else:
-                return ValueError('ValueError!\n'
-                                  'Not in set:(int) {}\n'
-                                  'or in set:(str) {}'.format(
-                    validation_set[0],
-                    validation_set[1]))
-        elif isinstance(value, str):
-            val = value.lower()
-            validator = self.find_element()
-            if validator(val, str(validation_set[1]).lower()):
-                return val.upper()
-            else:
-                return ValueError('ValueError!\n'
-                                  'Not in set:(str) {}\n'
-                                  'or in set:(int) {}'.format(
-                    validation_set[1],
-                    validation_set[0]))
-        else:
-            return TypeError('TypeError!\n'
-                             'Received type: {}\n'
-                             'Valid types: {}, {}'.format(
-                type(value), int, str))
+        return compile_rule(validation_set[0], validation_set[1],
+                            integer=True, span=False).check(value)
 
     def float_rng_tuple(self, validation_set, value, round_to):
-        if isinstance(value, (float, int)):
-            val = round(float(value), round_to)
-            validator = self.float_range()
-            if validator(val, validation_set):
-                return str(value)
-            else:
-                return ValueError('ValueError!\n'
-                                  'Not in range:(float, int) {}'
-                                  .format(validation_set))
-        else:
-            return TypeError('TypeError!\n'
-                             'Received type: {}\n'
-                             'Valid types: {}, {}'.format(
-                type(value), int, float))
+        return compile_rule(validation_set, round_to=round_to).check(value)
 
     def str_tuple(self, validation_set, value):
-        if isinstance(value, str):
-            val = value.lower()
-            validator = self.find_element()
-            if validator(val, str(validation_set).lower()):
-                return val.upper()
-            else:
-                return ValueError('ValueError!\n'
-                                  'Not in set:(str) {}'.format(
-                    validation_set))
-        else:
-            return TypeError('TypeError!\n'
-                             'Received type: {}\n'
-                             'Valid types: {}'.format(
-                type(value), str))
+        return compile_rule(keywords=validation_set).check(value)
 
     def int_tuple(self, validation_set, value):
-        if isinstance(value, int):
-            val = value
-            validator = self.find_element()
-            if validator(val, validation_set):
-                return str(val)
-            else:
-                return ValueError('ValueError!\n'
-                                  'Not in set:(int) {}'.format(
-                    validation_set))
-        else:
-            return TypeError('TypeError!\n'
-                             'Received type: {}\n'
-                             'Valid types: {}'.format(
-                type(value), int))
+        return compile_rule(validation_set, integer=True,
+                            span=False).check(value)
 
     def int_rng_tuple(self, validation_set, value):
-        if isinstance(value, int):
-            val = value
-            validator = self.int_range()
-            if validator(val, validation_set):
-                return str(val)
-            else:
-                return ValueError('ValueError!\n'
-                                  'Not in range:(int) {}'.format(
-                    validation_set))
-        else:
-            return TypeError('TypeError!\n'
-                             'Received type: {}\n'
-                             'Valid types: {}'.format(
-                type(value), int))
+        return compile_rule(validation_set, integer=True).check(value)
+
+
+MIN_MAX_DEF = ('MINimum', 'MAXimum', 'DEFault')
 
 
 class ValidateInput(Validate):
+    rules = {
+        'on_off': Rule((0, 1), ('ON', 'OFF'), integer=True, span=False),
+        'mode_dynamic': Rule(
+            keywords=('CURRent', 'VOLTage', 'POWer', 'RESistance')),
+        'mode_static': Rule(
+            keywords=('CURRent', 'VOLTage', 'POWer', 'RESistance', 'LED')),
+        'current_range': Rule((5, 30), integer=True, span=False),
+        'voltage_range': Rule((36, 150), integer=True, span=False),
+        'resistance_range': Rule(
+            keywords=('LOW', 'MIDDLE', 'HIGH', 'UPPER')),
+        'mode_transient': Rule(
+            keywords=('CONTinuous', 'PULSe', 'TOGGle')),
+        'pulse_width': Rule((0.00002, 999.0), MIN_MAX_DEF, round_to=6),
+        'power': Rule((0.0, 200.0), MIN_MAX_DEF, round_to=2),
+        'power_high': Rule((0.0, 300.0), MIN_MAX_DEF, round_to=2),
+        'resistance': Rule((0.03, 10000.0), MIN_MAX_DEF, round_to=3),
+        'voltage': Rule((0.0, 150), MIN_MAX_DEF, round_to=3),
+        'current': Rule((0.0, 30.0), MIN_MAX_DEF, round_to=3),
+        'slew': Rule((0.001, 2.5), MIN_MAX_DEF, round_to=3),
+        'mode_battery': Rule(
+            keywords=('CURRent', 'VOLTage', 'RESistance')),
+        'capacity': Rule((0, 999999), integer=True),
+        'timer': Rule((0, 86400), integer=True),
+        'trigger_source': Rule(keywords=('MANUal', 'EXTernal', 'BUS')),
+        'protection_delay': Rule((0.0, 60.0), MIN_MAX_DEF, round_to=3),
+    }
+
+    # Level rules for the sink modes of the battery, list and program tests
+    level_rules = {
+        'CURR': Rule((0.0, 30.0), round_to=3),
+        'VOLT': Rule((0.0, 150.0), round_to=3),
+        'LED': Rule((0.0, 150.0), round_to=3),
+        'RES': Rule((0.03, 10000.0), round_to=3),
+        'POW': Rule((0.0, 200.0), round_to=3),
+        'POW_HIGH': Rule((0.0, 300.0), round_to=3),
+    }
+
     def __init__(self, bus):
         self._bus = bus
-        self._high_power = global_input_values['high_power']
+        self._high_power = bus.input_values['high_power']
         super().__init__()
 
+    # Rule used by the validator called 'name', resolving the ones that
+    # depend on the model or on a sub-mode
+    def rule(self, name, step=1):
+        if name == 'power' and self._high_power:
+            return self.rules['power_high']
+        elif name == 'battery_level':
+            return self.level_rule(self._bus.mode(':BATT:MODE?'))
+        return self.rules[name]
+
+    # Level rule for the sink mode returned by a ':...:MODE?' query
+    def level_rule(self, mode):
+        mode = str(mode).upper()
+        for prefix in ('CURR', 'VOLT', 'LED', 'RES'):
+            if mode.startswith(prefix):
+                return self.level_rules[prefix]
+        if self._high_power:
+            return self.level_rules['POW_HIGH']
+        return self.level_rules['POW']
+
     def on_off(self, value):
-        on_off_values = (0, 1), ('ON', 'OFF')
-        return self.int_and_str_tuples(on_off_values, value)
+        return self.rules['on_off'].check(value)
 
     def mode_dynamic(self, value):
-        mode_values = ('CURRent', 'VOLTage', 'POWer', 'RESistance')
-        return self.str_tuple(mode_values, value)
+        return self.rules['mode_dynamic'].check(value)
 
     def mode_static(self, value):
-        mode_values = ('CURRent', 'VOLTage', 'POWer', 'RESistance', 'LED')
-        return self.str_tuple(mode_values, value)
+        return self.rules['mode_static'].check(value)
 
     def current_range(self, value):
-        current_range_values = (5, 30)
-        return self.int_tuple(current_range_values, value)
+        return self.rules['current_range'].check(value)
 
     def voltage_range(self, value):
-        voltage_range_values = (36, 150)
-        return self.int_tuple(voltage_range_values, value)
+        return self.rules['voltage_range'].check(value)
 
     def resistance_range(self, value):
-        resistance_range_values = ('LOW', 'MIDDLE', 'HIGH', 'UPPER')
-        return self.str_tuple(resistance_range_values, value)
+        return self.rules['resistance_range'].check(value)
 
     def mode_transient(self, value):
-        mode_values = ('CONTinuous', 'PULSe', 'TOGGle')
-        return self.str_tuple(mode_values, value)
+        return self.rules['mode_transient'].check(value)
 
     def pulse_width(self, value):
-        pulse_width_values = (0.00002, 999.0), ('MINimum', 'MAXimum', 'DEFault')
-        return self.float_rng_and_str_tuples(pulse_width_values, value, 6)
+        return self.rules['pulse_width'].check(value)
 
     def power(self, value):
-        if self._high_power:
-            power_values = (0.0, 300.0), ('MINimum', 'MAXimum', 'DEFault')
-        else:
-            power_values = (0.0, 200.0), ('MINimum', 'MAXimum', 'DEFault')
-        return self.float_rng_and_str_tuples(power_values, value, 2)
+        return self.rule('power').check(value)
 
     def resistance(self, value):
-        resistance_values = (0.03, 10000.0), ('MINimum', 'MAXimum', 'DEFault')
-        return self.float_rng_and_str_tuples(resistance_values, value, 3)
+        return self.rules['resistance'].check(value)
 
     def voltage(self, value):
-        voltage_values = (0.0, 150), ('MINimum', 'MAXimum', 'DEFault')
-        return self.float_rng_and_str_tuples(voltage_values, value, 3)
+        return self.rules['voltage'].check(value)
 
     def current(self, value):
-        current_values = (0.0, 30.0), ('MINimum', 'MAXimum', 'DEFault')
-        return self.float_rng_and_str_tuples(current_values, value, 3)
+        return self.rules['current'].check(value)
 
     def slew(self, value):
-        slew_values = (0.001, 2.5), ('MINimum', 'MAXimum', 'DEFault')
-        return self.float_rng_and_str_tuples(slew_values, value, 3)
+        return self.rules['slew'].check(value)
 
     def mode_battery(self, value):
-        mode_values = ('CURRent', 'VOLTage', 'RESistance')
-        return self.str_tuple(mode_values, value)
+        return self.rules['mode_battery'].check(value)
+
+    def trigger_source(self, value):
+        return self.rules['trigger_source'].check(value)
 
+    def protection_delay(self, value):
+        return self.rules['protection_delay'].check(value)
+
+    # The battery, list and program sub-modes are read through the bus
+    # cache, so validating a level does not cost a query every time
     def battery_level(self, value):
-        mode = self._bus.query(':BATT:MODE?')
-        if mode is 'CURRENT':
-            level_values = (0.0, 30.0)
-        elif mode is 'VOLTAGE':
-            level_values = (0.0, 150.0)
-        else:
-            level_values = (0.03, 10000.0)
-        return self.float_rng_tuple(level_values, value, 3)
+        return self.rule('battery_level').check(value)
 
     def capacity(self, value):
-        capacity_values = (0, 999999)
-        return self.int_rng_tuple(capacity_values, value)
+        return self.rules['capacity'].check(value)
+
+    # Seconds
+    def timer(self, value):
+        return self.rules['timer'].check(value)
 
 
 class ValidateTest(ValidateInput):
+    rules = dict(ValidateInput.rules, **{
+        'mode_list': Rule(
+            keywords=('CURRent', 'VOLTage', 'POWer', 'RESistance')),
+        'list_count': Rule((0, 255), integer=True),
+        'step_range': Rule((0, 100), integer=True),
+        # A list runs at least one step
+        'list_steps': Rule((1, 100), integer=True),
+        'step_delay': Rule((0.001, 999.0), MIN_MAX_DEF, round_to=3),
+        'led_rco': Rule((0.0, 1), MIN_MAX_DEF, round_to=2),
+        'step_time': Rule((0.01, 100.0), MIN_MAX_DEF, round_to=3),
+    })
+
     def __init__(self, bus):
         ValidateInput.__init__(self, bus)
         self._bus = bus
 
+    def rule(self, name, step=1):
+        if name == 'list_levels':
+            return self.level_rule(self._bus.mode(':LIST:MODE?'))
+        elif name == 'program_levels':
+            return self.level_rule(self._bus.mode(':PROG:MODE? ' + str(step)))
+        elif name == 'step_min_max':
+            mode = self._bus.mode(':PROG:MODE? ' + str(step))
+            return self.min_max_rule(mode)
+        return ValidateInput.rule(self, name, step)
+
+    # Program step min/max limit rule: a current in CV mode, else a voltage
+    def min_max_rule(self, mode):
+        if str(mode).upper().startswith('VOLT'):
+            return self.rules['current']
+        return self.rules['voltage']
+
+    def mode_list(self, value):
+        return self.rules['mode_list'].check(value)
+
     def list_levels(self, value):
-        mode = self._bus.query(':LIST:MODE?')
-        if mode is 'CURRENT':
-            level_values = (0.0, 30.0)
-        elif mode is 'VOLTAGE':
-            level_values = (0.0, 150.0)
-        elif mode is 'RESISTANCE':
-            level_values = (0.03, 10000.0)
-        elif self._high_power:
-            level_values = (0.0, 300.0)
-        else:
-            level_values = (0.0, 200.0)
-        return self.float_rng_tuple(level_values, value, 3)
-
-    def program_levels(self, value):
-        mode = self._bus.query(':PROG:MODE?')
-        if mode is 'CURRENT':
-            level_values = (0.0, 30.0)
-        elif mode is 'VOLTAGE' or 'LED':
-            level_values = (0.0, 150.0)
-        elif mode is 'RESISTANCE':
-            level_values = (0.03, 10000.0)
-        elif self._high_power:
-            level_values = (0.0, 300.0)
-        else:
-            level_values = (0.0, 200.0)
-        return self.float_rng_tuple(level_values, value, 3)
+        return self.rule('list_levels').check(value)
+
+    def program_levels(self, value, step=1):
+        return self.rule('program_levels', step).check(value)
 
     def list_count(self, value):
-        list_count_values = (0, 255)
-        return self.int_rng_tuple(list_count_values, value)
+        return self.rules['list_count'].check(value)
 
     def step_range(self, value):
-        list_step_values = (0, 100)
-        return self.int_rng_tuple(list_step_values, value)
+        return self.rules['step_range'].check(value)
+
+    def list_steps(self, value):
+        return self.rules['list_steps'].check(value)
 
     def step_delay(self, value):
-        delay_values = (0.001, 999.0), ('MINimum', 'MAXimum', 'DEFault')
-        return self.float_rng_and_str_tuples(delay_values, value)
+        return self.rules['step_delay'].check(value)
 
     def led_rco(self, value):
-        led_rco_values = (0.0, 1), ('MINimum', 'MAXimum', 'DEFault')
-        return self.float_rng_and_str_tuples(led_rco_values, value, 2)
+        return self.rules['led_rco'].check(value)
 
     def step_time(self, value):
-        step_time_values = (0.01, 100.0), ('MINimum', 'MAXimum', 'DEFault')
-        return self.float_rng_and_str_tuples(step_time_values, value)
+        return self.rules['step_time'].check(value)
 
-    def step_min_max(self, value):
-        mode = self._bus.query(':PROG:MODE?')
-        if mode is 'VOLTAGE':
-            return self.current(value)
-        else:
-            return self.voltage(value)
+    def step_min_max(self, value, step=1):
+        return self.rule('step_min_max', step).check(value)
 
 
 class ValidateRegister(Validate):
+    rules = {
+        'register_8': Rule((0, 128), integer=True),
+        'register_16': Rule((0, 65535), integer=True),
+        'preset': Rule((0, 9), integer=True),
+    }
+
     def __init__(self):
         super().__init__()
 
     def register_8(self, value):
-        register_values = (0, 128)
-        return self.int_rng_tuple(register_values, value)
+        return self.rules['register_8'].check(value)
 
     def register_16(self, value):
-        register_values = (0, 65535)
-        return self.int_rng_tuple(register_values, value)
+        return self.rules['register_16'].check(value)
 
     def preset(self, value):
-        preset_values = (0, 9)
-        return self.int_rng_tuple(preset_values, value)
+        return self.rules['preset'].check(value)
 
 
 class Command(Validate):
@@ -2037,31 +3908,47 @@ class Command(Validate):
 
     def read_write(self, query: str, write: str,
                    validator=None, value=None,
-                   value_dict=None, value_key=None):
+                   value_dict=None, value_key=None, confirm=None):
         if value is None:
-            return self._bus.query(query)
-        else:
-            if validator is not None:
-                val = validator(value)
-                if isinstance(val, (ValueError, TypeError)):
-                    print(self.error_text('WARNING', val))
-                else:
-                    write = write + ' ' + str(value)
-                    self._bus.write(write)
-                    if value_dict is not None:
-                        value_dict[value_key] = self._bus.query(query)
-                    return None
-
-            else:
-                write = write + ' ' + str(value)
-                self._bus.write(write)
-                if value_dict is not None:
-                    value_dict[value_key] = self._bus.query(query)
+            if value_dict is None:
+                return self._bus.query(query)
+            return self._bus.cached_query(query)
+        if validator is not None:
+            val = validator(value)
+            if isinstance(val, (ValueError, TypeError)):
+                print(self.error_text('WARNING', val))
                 return None
+            # Send the validated form, e.g. True as '1'
+            value = val
+        write = write + ' ' + str(value)
+        # Keep the write and its read-back together when shared by threads
+        with self._bus.lock:
+            self._bus.write(write)
+            self._bus.set_mode(query, str(value).upper())
+            if value_dict is not None:
+                self._confirm(
+                    query, value_dict, value_key, str(value), confirm)
+        return None
+
+    # Refresh value_dict after a write, following the read-back policy
+    def _confirm(self, query, value_dict, value_key, value, confirm=None):
+        policy = confirm or self._bus.write_confirm
+        if policy == 'never':
+            value = self._bus.convert(query, value)
+            value_dict[value_key] = value
+            self._bus.remember(query, value)
+        elif policy == 'deferred':
+            self._bus.defer(query, value_dict, value_key)
+        else:
+            self._bus.query_into(query, value_dict, value_key)
 
     def read(self, query: str):
         return self._bus.query(query)
 
+    # Query returning the undecoded response bytes
+    def read_raw(self, query: str):
+        return self._bus.query_raw(query)
+
     def write(self, write: str, validator=None):
         if validator is None:
             self._bus.write(write)
@@ -2071,3 +3958,537 @@ class Command(Validate):
                 print(self.error_text('WARNING', val))
             else:
                 self._bus.write(write)
+
+
+class Tracer:
+    # Records every bus transaction of a Device while attached:
+    #   tracer = dev.trace()            ; start tracing
+    #   dev.cc.level(2)
+    #   tracer.summary()                ; per header and per driver method
+    #   tracer.export_jsonl('trace.jsonl')
+    #   tracer.export_chrome('trace.json')  ; open in chrome://tracing
+    #   dev.trace(False)                ; stop tracing
+    # Latency histogram bins are upper edges in seconds, plus an overflow bin
+    histogram_bins = (1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 1e-1, 3e-1, 1.0)
+
+    def __init__(self, max_events=100000):
+        self.events = deque(maxlen=max_events)
+        self.headers = {}
+        self.messages = {}
+        self.callers = {}
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    # Header of each command in a message, e.g. ':CURR?' for ':CURR? 1'
+    @staticmethod
+    def headers_of(message):
+        return [command.strip().split(' ')[0]
+                for command in message.split(';') if command.strip()]
+
+    # Name of the driver method that caused the transaction, or the first
+    # function outside the driver (e.g. when a batch is sent)
+    @staticmethod
+    def caller():
+        frame = sys._getframe(2)
+        while frame is not None:
+            filename = frame.f_code.co_filename
+            if filename == contextmanager.__code__.co_filename:
+                frame = frame.f_back
+                continue
+            if filename != __file__:
+                return frame.f_code.co_name
+            owner = frame.f_locals.get('self')
+            if owner is not None and not isinstance(
+                    owner, (Bus, Command, Validate, Tracer, Transport,
+                            _AsyncProxy)):
+                return type(owner).__name__ + '.' + frame.f_code.co_name
+            frame = frame.f_back
+        return ''
+
+    def record(self, kind, command, start, duration, caller=''):
+        headers = self.headers_of(command)
+        message = ';'.join(headers) or kind
+        with self._lock:
+            self.events.append({
+                'start': start - self._start,
+                'duration': duration,
+                'kind': kind,
+                'command': command,
+                'caller': caller,
+                'thread': threading.get_ident()})
+            for header in headers:
+                self.headers[header] = self.headers.get(header, 0) + 1
+            stats = self.messages.setdefault(message, {
+                'count': 0, 'total': 0.0,
+                'histogram': [0] * (len(self.histogram_bins) + 1)})
+            stats['count'] += 1
+            stats['total'] += duration
+            stats['histogram'][
+                bisect_left(self.histogram_bins, duration)] += 1
+            stats = self.callers.setdefault(caller, {'count': 0, 'total': 0.0})
+            stats['count'] += 1
+            stats['total'] += duration
+
+    def clear(self):
+        with self._lock:
+            self.events.clear()
+            self.headers.clear()
+            self.messages.clear()
+            self.callers.clear()
+
+    # Totals per message and per calling driver method, slowest first
+    def summary(self):
+        with self._lock:
+            return {
+                'headers': dict(self.headers),
+                'messages': dict(sorted(
+                    self.messages.items(), key=lambda item: -item[1]['total'])),
+                'callers': dict(sorted(
+                    self.callers.items(), key=lambda item: -item[1]['total']))}
+
+    def export_jsonl(self, path):
+        with self._lock:
+            events = list(self.events)
+        with open(path, 'w') as file:
+            for event in events:
+                file.write(json.dumps(event) + '\n')
+
+    # Chrome trace event format, for chrome://tracing or Perfetto
+    def export_chrome(self, path):
+        with self._lock:
+            events = list(self.events)
+        trace = [{
+            'name': ';'.join(self.headers_of(event['command']))
+                    or event['kind'],
+            'cat': event['kind'],
+            'ph': 'X',
+            'ts': event['start'] * 1e6,
+            'dur': event['duration'] * 1e6,
+            'pid': 1,
+            'tid': event['thread'],
+            'args': {'command': event['command'], 'caller': event['caller']}}
+            for event in events]
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': trace}, file)
+
+
+class Transport:
+    # Connection to the instrument used by Bus. A transport sends and
+    # receives '\n' terminated SCPI messages
+    def write(self, command: str):
+        raise NotImplementedError
+
+    def read(self):
+        raise NotImplementedError
+
+    def query(self, command: str):
+        self.write(command)
+        return self.read()
+
+    def read_raw(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class VisaTransport(Transport):
+    # pyvisa resource, pyvisa is only imported when this is used
+    def __init__(self, visa_addr):
+        import pyvisa
+        self._visa_driver = pyvisa.ResourceManager()
+        self._resource = self._visa_driver.open_resource(visa_addr)
+        self._resource.read_termination = '\n'
+        self._resource.write_termination = '\n'
+
+    def write(self, command: str):
+        self._resource.write(command)
+
+    def read(self):
+        return self._resource.read()
+
+    def query(self, command: str):
+        return self._resource.query(command)
+
+    def read_raw(self):
+        return self._resource.read_raw()
+
+    def close(self):
+        self._resource.close()
+
+
+class SocketTransport(Transport):
+    # Raw SCPI over TCP (port 5025) for LAN connected loads, without pyvisa
+    def __init__(self, host, port=5025, timeout=5.0):
+        self._socket = socket.create_connection((host, port), timeout)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._buffer = bytearray()
+
+    def write(self, command: str):
+        self._socket.sendall(command.encode() + b'\n')
+
+    def read(self):
+        return self.read_raw().decode().rstrip('\r\n')
+
+    # Read one response including its '\n' termination
+    def read_raw(self):
+        end = self._buffer.find(b'\n')
+        while end < 0:
+            start = len(self._buffer)
+            chunk = self._socket.recv(65536)
+            if not chunk:
+                raise ConnectionError('Connection closed by instrument')
+            self._buffer += chunk
+            end = self._buffer.find(b'\n', start)
+        raw = bytes(self._buffer[:end + 1])
+        del self._buffer[:end + 1]
+        return raw
+
+    def close(self):
+        self._socket.close()
+
+
+class BatchResult:
+    # Response to a query queued in Device.batch(), set when it is sent
+    def __init__(self, query, value_dict=None, value_key=None, cache=None):
+        self.query = query
+        self.value = None
+        self.done = False
+        self._value_dict = value_dict
+        self._value_key = value_key
+        self._cache = cache
+        self._callbacks = []
+
+    def __repr__(self):
+        return 'BatchResult({!r}, {!r})'.format(self.query, self.value)
+
+    # Call callback(value) when the response is set, or now if it is
+    def then(self, callback):
+        if self.done:
+            callback(self.value)
+        else:
+            self._callbacks.append(callback)
+
+    def set(self, value):
+        self.value = value
+        self.done = True
+        if self._value_dict is not None:
+            self._value_dict[self._value_key] = value
+        if self._cache is not None:
+            self._cache.remember(self.query, value)
+        for callback in self._callbacks:
+            callback(value)
+        self._callbacks = []
+
+    # Replace the BatchResults in a dictionary by their responses once
+    # they are set, e.g. 'values' read inside Device.batch()
+    @staticmethod
+    def resolve(values):
+        for key, value in values.items():
+            if isinstance(value, BatchResult):
+                value.then(partial(values.__setitem__, key))
+
+
+class Bus:
+    # All SCPI traffic from Command passes through the device's Bus to its
+    # Transport. 'lock' serializes access to the instrument so one Device
+    # can be shared between threads, batches are kept per thread
+    def __init__(self, transport):
+        self._transport = transport
+        # Tracks input: on/off, short: on/off, mode, model, high_power
+        self.input_values = {}
+        self.write_confirm = 'always'
+        self.lock = threading.RLock()
+        self.tracer = None
+        # Cached responses of the sub-mode queries used by the validators
+        self.modes = {}
+        # Bumped whenever the instrument state may have changed behind the
+        # driver (*RST, *RCL, invalidate), dropping cached contents
+        self.generation = 0
+        # Getter cache, query: (response, time), used when cache_ttl is set
+        self.cache_ttl = None
+        self._cache = {}
+        # Convert responses with response_converter(), see set_typed()
+        self.typed = False
+        self._converters = {}
+        self._deferred = []
+        self._local = threading.local()
+
+    @property
+    def _batch(self):
+        return getattr(self._local, 'batch', None)
+
+    @_batch.setter
+    def _batch(self, batch):
+        self._local.batch = batch
+
+    # Sub-mode queries kept in 'modes', updated by the driver's own writes
+    mode_queries = (':BATT:MODE?', ':LIST:MODE?', ':PROG:MODE?')
+
+    # Cached sub-mode, queried only the first time (also inside a batch)
+    def mode(self, query: str):
+        value = self.modes.get(query)
+        if value is None:
+            with self.lock:
+                value = self._call('query', query, self._transport.query)
+            self.modes[query] = value
+        return value
+
+    def set_mode(self, query: str, value):
+        if query.startswith(self.mode_queries):
+            self.modes[query] = value
+
+    # Settings whose state can change without a command from the driver
+    uncached = (':INP?', ':PROG:TEST?', ':TIME:TEST:RISE?',
+                ':TIME:TEST:FALL?')
+    # Headers after which the cached settings may no longer hold
+    cache_clearing = FUNCTION_HEADERS + (
+        ':SYST:LOCK', ':SYST:REM', ':SYST:LOC')
+
+    # The getter cache is only changed under 'lock', a Device may be shared
+    # between a writing and a polling thread
+    def invalidate(self):
+        with self.lock:
+            self.modes.clear()
+            self._cache.clear()
+            self.generation += 1
+
+    def set_typed(self, enable):
+        with self.lock:
+            self.typed = bool(enable)
+            self._cache.clear()
+
+    # Typed value of the response to one query, the converter is looked up
+    # once per header. Joined queries and untyped buses return it unchanged
+    def convert(self, command: str, response):
+        if not self.typed or ';' in command or not isinstance(response, str):
+            return response
+        header = command.split(' ', 1)[0]
+        converter = self._converters.get(header)
+        if converter is None:
+            converter = self._converters[header] = response_converter(header)
+        return converter(response)
+
+    def set_cache(self, ttl):
+        with self.lock:
+            self.cache_ttl = ttl
+            self._cache.clear()
+
+    # Query a setting, served from the cache while it is fresh
+    def cached_query(self, command: str):
+        if self.cache_ttl is None or command.startswith(self.uncached):
+            return self.query(command)
+        with self.lock:
+            entry = self._cache.get(command)
+        if entry is not None and \
+                time.monotonic() - entry[1] <= self.cache_ttl:
+            if self._batch is None:
+                return entry[0]
+            # Getters return a BatchResult throughout a batch
+            result = BatchResult(command)
+            result.set(entry[0])
+            return result
+        if self._batch is not None:
+            result = BatchResult(command, cache=self)
+            self._batch.append((command, result))
+            return result
+        with self.lock:
+            value = self.convert(command, self._call(
+                'query', command, self._transport.query))
+            self.remember(command, value)
+        return value
+
+    def remember(self, command: str, value):
+        if self.cache_ttl is not None and \
+                not command.startswith(self.uncached):
+            with self.lock:
+                self._cache[command] = (value, time.monotonic())
+
+    # Drop the cached settings a written message may have changed
+    def _written(self, message: str):
+        with self.lock:
+            for command in message.split(';'):
+                header = command.strip().split(' ', 1)[0].upper()
+                if not header.startswith((':', '*')):
+                    header = ':' + header
+                if header.startswith(('*RST', '*RCL')):
+                    self.invalidate()
+                elif header.startswith(self.cache_clearing) or \
+                        header.endswith(':STAT:ON'):
+                    self._cache.clear()
+                elif self._cache:
+                    prefix = header + '?'
+                    for query in [query for query in self._cache
+                                  if query.startswith(prefix)]:
+                        del self._cache[query]
+
+    # Run one transport call, timing it when a Tracer is attached
+    def _call(self, kind, command, func):
+        args = (command,) if command else ()
+        if self.tracer is None:
+            return func(*args)
+        caller = self.tracer.caller()
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.tracer.record(
+                kind, command, start, time.perf_counter() - start, caller)
+
+    def write(self, command: str):
+        self._written(command)
+        if self._batch is not None:
+            self._batch.append((command, None))
+        else:
+            with self.lock:
+                self._call('write', command, self._transport.write)
+
+    def read(self):
+        with self.lock:
+            self.flush()
+            return self._call('read', '', self._transport.read)
+
+    def query(self, command: str):
+        if self._batch is not None:
+            result = BatchResult(command)
+            self._batch.append((command, result))
+            return result
+        with self.lock:
+            return self.convert(command, self._call(
+                'query', command, self._transport.query))
+
+    # Query and store the response in value_dict[value_key]
+    def query_into(self, command: str, value_dict, value_key):
+        if self._batch is not None:
+            result = BatchResult(command, value_dict, value_key, self)
+            self._batch.append((command, result))
+            value_dict[value_key] = result
+        else:
+            with self.lock:
+                value_dict[value_key] = self.convert(command, self._call(
+                    'query', command, self._transport.query))
+            self.remember(command, value_dict[value_key])
+
+    def read_raw(self):
+        with self.lock:
+            self.flush()
+            return self._call('read_raw', '', self._transport.read_raw)
+
+    # Numeric responses of one or more ';' joined queries as a float array,
+    # parsed from the response text whether or not the bus is typed.
+    # Sends a pending batch first, like query_raw()
+    def query_values(self, command: str):
+        with self.lock:
+            self.flush()
+            response = self._call('query', command, self._transport.query)
+        return np.fromstring(response, sep=';')
+
+    def query_raw(self, command: str):
+        with self.lock:
+            self.flush()
+            return self._call('query_raw', command, self._query_raw)
+
+    def _query_raw(self, command: str):
+        self._transport.write(command)
+        return self._transport.read_raw()
+
+    def close(self):
+        with self.lock:
+            self._transport.close()
+
+    def set_write_confirm(self, policy):
+        if policy not in WRITE_CONFIRM_POLICIES:
+            print(Validate().error_text('WARNING', ValueError(
+                'ValueError!\n'
+                'Not in set:(str) {}'.format(WRITE_CONFIRM_POLICIES))))
+            return
+        if policy != 'deferred':
+            self.confirm()
+        self.write_confirm = policy
+
+    # Join commands into one message, each starting from the root node
+    @staticmethod
+    def join(commands):
+        return ';'.join(
+            command if command.startswith((':', '*')) else ':' + command
+            for command in commands)
+
+    # Query several commands using as few bus messages as possible
+    def query_many(self, queries):
+        if self._batch is not None:
+            return [self.query(query) for query in queries]
+        results = []
+        with self.lock:
+            for i in range(0, len(queries), MAX_MESSAGE_COMMANDS):
+                chunk = queries[i:i + MAX_MESSAGE_COMMANDS]
+                message = self.join(chunk)
+                responses = self._split_responses(message, self._call(
+                    'query', message, self._transport.query), len(chunk))
+                results.extend(
+                    self.convert(query, response) for query, response in
+                    zip(chunk, responses))
+        return results
+
+    # Responses to a joined message, one per query. A missing or extra
+    # field would shift every later response onto the wrong query
+    @staticmethod
+    def _split_responses(message, response, count):
+        responses = response.split(';')
+        if len(responses) != count:
+            raise ValueError(
+                '{} responses to {} queries in {!r}: {!r}'.format(
+                    len(responses), count, message, response))
+        return responses
+
+    # Queue a read-back for the 'deferred' write confirm policy
+    def defer(self, query, value_dict, value_key):
+        with self.lock:
+            self._deferred.append((query, value_dict, value_key))
+
+    def confirm(self):
+        with self.lock:
+            deferred, self._deferred = self._deferred, []
+            if not deferred:
+                return
+            if self._batch is not None:
+                for query, value_dict, value_key in deferred:
+                    self.query_into(query, value_dict, value_key)
+                return
+            results = self.query_many([query for query, _, _ in deferred])
+            for (query, value_dict, value_key), result in zip(
+                    deferred, results):
+                value_dict[value_key] = result
+                self.remember(query, result)
+
+    @contextmanager
+    def batch(self):
+        # Nested batches join the outer one
+        if self._batch is not None:
+            yield self
+            return
+        self._batch = []
+        try:
+            yield self
+            self.flush()
+        finally:
+            self._batch = None
+
+    # Send the queued batch, splitting query responses back to each result
+    def flush(self):
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+        with self.lock:
+            for i in range(0, len(batch), MAX_MESSAGE_COMMANDS):
+                chunk = batch[i:i + MAX_MESSAGE_COMMANDS]
+                message = self.join([command for command, _ in chunk])
+                results = [
+                    result for _, result in chunk if result is not None]
+                if results:
+                    responses = self._split_responses(message, self._call(
+                        'query', message, self._transport.query),
+                        len(results))
+                    for result, response in zip(results, responses):
+                        result.set(self.convert(result.query, response))
+                else:
+                    self._call('write', message, self._transport.write)
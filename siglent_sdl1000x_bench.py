@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import sys
+import time
+
+import siglent_sdl1000x as sdl
+from siglent_sdl1000x_sim import SimulatedLoad
+
+'''
+Driver benchmarks for the SDL1000X driver, run against SimulatedLoad
+
+Each benchmark reports the bus transactions and wall clock time per call,
+one JSON object per line, so round trip regressions can be diffed:
+
+    python siglent_sdl1000x_bench.py --rtt 0.001 --output bench.jsonl
+    python siglent_sdl1000x_bench.py --only cc. --repeat 50
+
+    {"name": "cc.level.set", "transactions": 2.0, "seconds": 0.0021, ...}
+
+'--rtt' is the latency the simulator adds to each transaction.
+'''
+
+WAVE_REPLY = (','.join(
+    '{:f}'.format(0.01 * i) for i in range(sdl.WAVE_SAMPLES)) + ',\n').encode()
+
+# name: setup(dev) returning the operation to time, registered in order
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+@benchmark('device.open')
+def _device_open(dev):
+    return lambda: sdl.Device(transport=dev._bus._transport)
+
+
+@benchmark('cc.values')
+def _cc_values(dev):
+    def run():
+        dev.cc._values = None
+        return dev.cc.values
+    return run
+
+
+@benchmark('cc.level.get')
+def _cc_level_get(dev):
+    return dev.cc.level
+
+
+@benchmark('cc.level.set')
+def _cc_level_set(dev):
+    return lambda: dev.cc.level(1.5)
+
+
+@benchmark('cc.level.get.cached')
+def _cc_level_get_cached(dev):
+    dev.cache(float('inf'))
+    return dev.cc.level
+
+
+@benchmark('cc.slew_pos.set')
+def _cc_slew_set(dev):
+    return lambda: dev.cc.slew_pos(0.5)
+
+
+@benchmark('cc.level.set.never_confirm')
+def _cc_level_set_never(dev):
+    dev.write_confirm('never')
+    return lambda: dev.cc.level(1.5)
+
+
+@benchmark('list.level.set')
+def _list_level_set(dev):
+    return lambda: dev.test.list.level(2, 1.0)
+
+
+@benchmark('list.width.set')
+def _list_width_set(dev):
+    return lambda: dev.test.list.width(2, 0.5)
+
+
+@benchmark('list.load')
+def _list_load(dev):
+    levels = [0.1 * step for step in range(1, 101)]
+    return lambda: dev.test.list.load(levels, 0.5, 0.01, force=True)
+
+
+@benchmark('list.load.unchanged')
+def _list_load_unchanged(dev):
+    levels = [0.1 * step for step in range(1, 101)]
+    dev.test.list.load(levels, 0.5, 0.01)
+    return lambda: dev.test.list.load(levels, 0.5, 0.01)
+
+
+@benchmark('prog.level.set')
+def _prog_level_set(dev):
+    return lambda: dev.test.prog.level(2, 1.0)
+
+
+@benchmark('prog.time_on.set')
+def _prog_time_on_set(dev):
+    return lambda: dev.test.prog.time_on(2, 1.0)
+
+
+@benchmark('prog.download')
+def _prog_download(dev):
+    return dev.test.prog.download
+
+
+@benchmark('prog.upload.one_cell')
+def _prog_upload(dev):
+    table = dev.test.prog.download()
+
+    def run():
+        table['time_on'][0] = 2.0 if table['time_on'][0] == 1.0 else 1.0
+        dev.test.prog.upload(table)
+    return run
+
+
+@benchmark('meas.voltage')
+def _meas_voltage(dev):
+    return dev.meas.voltage
+
+
+@benchmark('meas.voltage.typed')
+def _meas_voltage_typed(dev):
+    dev.typed(True)
+    return dev.meas.voltage
+
+
+@benchmark('meas.snapshot')
+def _meas_snapshot(dev):
+    return dev.meas.snapshot
+
+
+@benchmark('meas.wave_voltage')
+def _meas_wave(dev):
+    return dev.meas.wave_voltage
+
+
+@benchmark('meas.parse_wave')
+def _parse_wave(dev):
+    return lambda: sdl.Measure.parse_wave(WAVE_REPLY)
+
+
+@benchmark('cc.sweep.100')
+def _cc_sweep(dev):
+    setpoints = [0.05 * point for point in range(100)]
+    return lambda: dev.cc.sweep(setpoints)
+
+
+@benchmark('time.capture.100')
+def _time_capture(dev):
+    return lambda: dev.test.time.capture(100)
+
+
+def _dynamic_profile(dev):
+    dyn = dev.cc.dyn
+    dyn.set_a_and_b(0.25, 1.5, 0.002, 0.0001)
+    dyn.pulse_mode('CONT')
+    dyn.current_range(5)
+    dyn.voltage_range(36)
+    dyn.set_slew_both(0.5)
+
+
+@benchmark('profile.cc_dynamic')
+def _profile(dev):
+    return lambda: _dynamic_profile(dev)
+
+
+@benchmark('profile.cc_dynamic.batch')
+def _profile_batch(dev):
+    def run():
+        with dev.batch():
+            _dynamic_profile(dev)
+    return run
+
+
+# Time one benchmark, returning its result record
+def run_benchmark(name, setup, rtt=0.0, repeat=20):
+    sim = SimulatedLoad(latency=rtt, seed=0)
+    dev = sdl.Device(transport=sim)
+    operation = setup(dev)
+    times = []
+    start_transactions = sim.transactions
+    for _ in range(repeat):
+        start = time.perf_counter()
+        operation()
+        times.append(time.perf_counter() - start)
+    return {
+        'name': name,
+        'transactions': (sim.transactions - start_transactions) / repeat,
+        'seconds': sum(times) / repeat,
+        'min_seconds': min(times),
+        'max_seconds': max(times),
+        'repeat': repeat,
+        'rtt': rtt}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the SDL1000X driver against SimulatedLoad')
+    parser.add_argument('--rtt', type=float, default=0.0,
+                        help='latency added to each transaction (s)')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--only', default='',
+                        help='run benchmarks whose name starts with this')
+    parser.add_argument('--output', help='write JSON lines to this file')
+    args = parser.parse_args(argv)
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for name, setup in BENCHMARKS.items():
+            if not name.startswith(args.only):
+                continue
+            result = run_benchmark(name, setup, args.rtt, args.repeat)
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,512 @@
+# -*- coding: utf-8 -*-
+
+import math
+import random
+import time
+
+from siglent_sdl1000x import Transport, WAVE_SAMPLES
+
+'''
+Simulated Siglent SDL1000X series DC electronic load
+
+Implements the SCPI command set in raw_scpi_commands.txt as an in-process
+Transport, so the driver can be used without an instrument:
+
+                            import siglent_sdl1000x as dev
+                            from siglent_sdl1000x_sim import SimulatedLoad
+                            sim = SimulatedLoad(source_voltage=12.0)
+                            dev = dev.Device(transport=sim)
+
+The load sinks from a source modelled as a voltage behind a resistance,
+with an optional current limit (a bench supply in CC foldback):
+
+        sim.source_voltage = 5.0        ; open circuit voltage (V)
+        sim.source_resistance = 0.05    ; internal resistance (Ohm)
+        sim.current_limit = 3.0         ; supply current limit (A) or None
+
+Settings are kept per command and returned by the matching query.
+The input is modelled in the static, dynamic (level A), LED and battery
+modes. 'MEAS:WAVE?' returns 200 samples around the operating point.
+
+        sim.latency = 0.002             ; seconds added to each transaction
+        sim.transactions                ; messages sent to the load
+'''
+
+# SCPI mnemonics, the upper case part is the short form
+MNEMONICS = (
+    'SOURce', 'CURRent', 'VOLTage', 'POWer', 'RESistance', 'LEVel',
+    'IMMediate', 'IRANGe', 'VRANGe', 'RRANGe', 'SLEW', 'BOTH', 'POSitive',
+    'NEGative', 'TRANsient', 'MODE', 'ALEVel', 'BLEVel', 'AWIDth', 'BWIDth',
+    'LED', 'RCOnf', 'BATTery', 'FUNCtion', 'CAPability', 'TIMer', 'STATe',
+    'DISCHArg', 'LIST', 'COUNt', 'STEP', 'WIDth', 'OCP', 'OPP', 'STARt',
+    'DELay', 'END', 'MIN', 'MAX', 'PROGram', 'SHORt', 'PAUSE', 'TIME', 'ON',
+    'OFF', 'TEST', 'LATCh', 'EXT', 'INPut', 'PROTection', 'SYSTem',
+    'SENSe', 'IMONItor', 'VMONItor', 'STOP', 'FAIL', 'TRIGger', 'AVERage',
+    'LOW', 'HIGH', 'RISE', 'FALL', 'MEASure', 'WAVE', 'ERRor')
+
+NODES = {}
+for mnemonic in MNEMONICS:
+    short = ''.join(c for c in mnemonic if c.isupper())
+    NODES[short] = short
+    NODES[mnemonic.upper()] = short
+
+# Headers with optional trailing nodes, as sent without them
+ALIASES = {
+    'CURR:SLEW:BOTH': 'CURR:SLEW',
+    'LIST:SLEW:BOTH': 'LIST:SLEW',
+    'INP:STAT': 'INP',
+    'SYST:SENS:STAT': 'SYST:SENS',
+    'SYST:IMONI:STAT': 'SYST:IMONI',
+    'SYST:VMONI:STAT': 'SYST:VMONI',
+    'STOP:ON:FAIL:STAT': 'STOP:ON:FAIL',
+    'TIME:TEST:STAT': 'TIME:TEST',
+    'EXT:INP:STAT': 'EXT:INP',
+    'VOLT:LATC:STAT': 'VOLT:LATC',
+    'VOLT:LEV:ON': 'VOLT:ON'}
+
+# Keyword parameters, returned in their long form
+KEYWORDS = {}
+for keyword in ('CURRent', 'VOLTage', 'POWer', 'RESistance', 'LED',
+                'CONTinuous', 'PULSe', 'TOGGle', 'LOW', 'MIDDLE', 'HIGH',
+                'UPPER', 'MANUal', 'EXTernal', 'BUS', 'INT', 'EXTI',
+                'EXTV'):
+    short = ''.join(c for c in keyword if c.isupper())
+    KEYWORDS[short] = KEYWORDS[keyword.upper()] = keyword.upper()
+
+CURRENT = (0.0, 30.0)
+VOLTAGE = (0.0, 150.0)
+RESISTANCE = (0.03, 10000.0)
+SLEW = (0.001, 2.5)
+WIDTH = (0.00002, 999.0)
+STEP_TIME = (0.01, 100.0)
+
+
+def _settings(power):
+    # header: (type, default, range) for every setting
+    settings = {
+        'INP': ('bool', 0, None),
+        'SHOR': ('bool', 0, None),
+        'FUNC': ('enum', 'CURRENT', None),
+        'FUNC:TRAN': ('enum', 'CURRENT', None),
+        'CURR:SLEW:POS': ('float', 0.5, SLEW),
+        'CURR:SLEW:NEG': ('float', 0.5, SLEW),
+        'CURR:TRAN:SLEW:POS': ('float', 0.5, SLEW),
+        'CURR:TRAN:SLEW:NEG': ('float', 0.5, SLEW),
+        'RES:RRANG': ('enum', 'LOW', None),
+        'RES:TRAN:RRANG': ('enum', 'LOW', None),
+        'LED:IRANG': ('int', 30, None),
+        'LED:VRANG': ('int', 150, None),
+        'LED:VOLT': ('float', 1.0, VOLTAGE),
+        'LED:CURR': ('float', 0.1, CURRENT),
+        'LED:RCO': ('float', 0.1, (0.0, 1.0)),
+        'BATT:MODE': ('enum', 'CURRENT', None),
+        'BATT:IRANG': ('int', 30, None),
+        'BATT:VRANG': ('int', 150, None),
+        'BATT:RRANG': ('enum', 'LOW', None),
+        'BATT:LEV': ('float', 0.1, (0.0, 10000.0)),
+        'BATT:VOLT': ('float', 0.0, VOLTAGE),
+        'BATT:CAP': ('int', 0, (0, 999999)),
+        'BATT:TIM': ('int', 0, (0, 86400)),
+        'BATT:VOLT:STAT': ('bool', 0, None),
+        'BATT:CAP:STAT': ('bool', 0, None),
+        'BATT:TIM:STAT': ('bool', 0, None),
+        'LIST:MODE': ('enum', 'CURRENT', None),
+        'LIST:IRANG': ('int', 30, None),
+        'LIST:VRANG': ('int', 150, None),
+        'LIST:RRANG': ('enum', 'LOW', None),
+        'LIST:COUN': ('int', 1, (0, 255)),
+        'LIST:STEP': ('int', 2, (1, 100)),
+        'PROG:STEP': ('int', 2, (1, 10)),
+        'SYST:SENS': ('bool', 0, None),
+        'SYST:IMONI': ('bool', 0, None),
+        'SYST:VMONI': ('bool', 0, None),
+        'STOP:ON:FAIL': ('bool', 0, None),
+        'TRIG:SOUR': ('enum', 'MANUAL', None),
+        'SENS:AVER:COUN': ('int', 14, (6, 14)),
+        'EXT:MODE': ('enum', 'INT', None),
+        'EXT:IRANG': ('int', 30, None),
+        'EXT:VRANG': ('int', 150, None),
+        'EXT:INP': ('bool', 0, None),
+        'TIME:TEST': ('bool', 0, None),
+        'TIME:TEST:VOLT:LOW': ('float', 1.0, VOLTAGE),
+        'TIME:TEST:VOLT:HIGH': ('float', 10.0, VOLTAGE),
+        'VOLT:ON': ('float', 0.0, VOLTAGE),
+        'VOLT:LATC': ('bool', 0, None),
+        'CURR:PROT:STAT': ('bool', 0, None),
+        'CURR:PROT:LEV': ('float', 30.0, CURRENT),
+        'CURR:PROT:DEL': ('float', 0.0, (0.0, 60.0)),
+        'POW:PROT:STAT': ('bool', 0, None),
+        'POW:PROT:LEV': ('float', power[1], power),
+        'POW:PROT:DEL': ('float', 0.0, (0.0, 60.0))}
+    levels = {'CURR': (1.0, CURRENT), 'VOLT': (150.0, VOLTAGE),
+              'POW': (1.0, power), 'RES': (10000.0, RESISTANCE)}
+    for root, (default, limits) in levels.items():
+        settings[root] = ('float', default, limits)
+        settings[root + ':IRANG'] = ('int', 30, None)
+        settings[root + ':VRANG'] = ('int', 150, None)
+        settings[root + ':TRAN:MODE'] = ('enum', 'CONTINUOUS', None)
+        settings[root + ':TRAN:IRANG'] = ('int', 30, None)
+        settings[root + ':TRAN:VRANG'] = ('int', 150, None)
+        settings[root + ':TRAN:ALEV'] = ('float', default, limits)
+        settings[root + ':TRAN:BLEV'] = ('float', default, limits)
+        settings[root + ':TRAN:AWID'] = ('float', 0.001, WIDTH)
+        settings[root + ':TRAN:BWID'] = ('float', 0.001, WIDTH)
+    for root, limits in (('OCP', CURRENT), ('OPP', power)):
+        settings[root + ':IRANG'] = ('int', 30, None)
+        settings[root + ':VRANG'] = ('int', 150, None)
+        settings[root + ':STAR'] = ('float', limits[0], limits)
+        settings[root + ':STEP'] = ('float', 0.01 * limits[1], limits)
+        settings[root + ':STEP:DEL'] = ('float', 0.01, (0.001, 999.0))
+        settings[root + ':END'] = ('float', 0.1 * limits[1], limits)
+        settings[root + ':MIN'] = ('float', limits[0], limits)
+        settings[root + ':MAX'] = ('float', limits[1], limits)
+        settings[root + ':VOLT'] = ('float', 0.0, VOLTAGE)
+    return settings
+
+
+def _step_settings():
+    # Settings kept for each step of a list or program
+    return {
+        'LIST:LEV': ('float', 0.0, (0.0, 10000.0)),
+        'LIST:SLEW': ('float', 0.5, SLEW),
+        'LIST:WID': ('float', 1.0, WIDTH),
+        'PROG:MODE': ('enum', 'CURRENT', None),
+        'PROG:IRANG': ('int', 30, None),
+        'PROG:VRANG': ('int', 150, None),
+        'PROG:RRANG': ('enum', 'LOW', None),
+        'PROG:SHOR': ('bool', 0, None),
+        'PROG:PAUSE': ('bool', 0, None),
+        'PROG:TIME:ON': ('float', 1.0, STEP_TIME),
+        'PROG:TIME:OFF': ('float', 0.0, STEP_TIME),
+        'PROG:TIME:DEL': ('float', 0.0, STEP_TIME),
+        'PROG:MIN': ('float', 0.0, VOLTAGE),
+        'PROG:MAX': ('float', 150.0, VOLTAGE),
+        'PROG:LEV': ('float', 0.0, (0.0, 10000.0)),
+        'PROG:LED:CURR': ('float', 0.1, CURRENT),
+        'PROG:LED:RCO': ('float', 0.1, (0.0, 1.0))}
+
+
+# Commands that switch the active function, with the function name
+FUNCTION_COMMANDS = {
+    'LIST:STAT:ON': 'LIST',
+    'BATT:FUNC': 'BATTERY',
+    'OCP:FUNC': 'OCP',
+    'OPP:FUNC': 'OPP',
+    'PROG:STAT:ON': 'PROGRAM'}
+
+FUNCTION_QUERIES = {
+    'LIST:STAT': 'LIST',
+    'BATT:FUNC': 'BATTERY',
+    'OCP:FUNC': 'OCP',
+    'OPP:FUNC': 'OPP',
+    'PROG:STAT': 'PROGRAM'}
+
+MEASUREMENTS = {
+    'VOLT': 'voltage', 'CURR': 'current', 'POW': 'power',
+    'RES': 'resistance'}
+
+# SCPI root node for each sink mode
+MEASUREMENTS_ROOT = {
+    'CURRENT': 'CURR', 'VOLTAGE': 'VOLT', 'POWER': 'POW',
+    'RESISTANCE': 'RES'}
+
+
+class SimulatedLoad(Transport):
+    def __init__(self, model='SDL1020X-E', source_voltage=12.0,
+                 source_resistance=0.05, current_limit=None,
+                 latency=0.0, noise=0.0005, seed=None):
+        self.model = model
+        self.source_voltage = source_voltage
+        self.source_resistance = source_resistance
+        self.current_limit = current_limit
+        self.latency = latency
+        self.noise = noise
+        # TIME:TEST results returned by the simulator (seconds)
+        self.rise_time = 0.001
+        self.fall_time = 0.002
+        self.transactions = 0
+        self.trigger_times = []
+        self._random = random.Random(seed)
+        power = (0.0, 300.0) if model in ('SDL1030X-E', 'SDL1030X') \
+            else (0.0, 200.0)
+        self._settings = _settings(power)
+        self._step_settings = _step_settings()
+        self._saved = {}
+        self._errors = []
+        self._responses = []
+        self.reset()
+
+    # *RST, restore the default settings and turn the input off
+    def reset(self):
+        self.state = {
+            header: default
+            for header, (_, default, _) in self._settings.items()}
+        self.steps = {}
+        self.function = 'STATIC'
+        self._discharge_start = None
+        self._discharge_capacity = 0.0
+        self._discharge_time = 0.0
+        self._discharge_stamp = None
+        self._ramp_stamp = None
+
+    ####################
+    # Transport        #
+    ####################
+
+    def write(self, command: str):
+        self.transactions += 1
+        if self.latency:
+            time.sleep(self.latency)
+        for part in command.split(';'):
+            if part.strip():
+                self._command(part.strip())
+
+    def read(self):
+        responses, self._responses = self._responses, []
+        return ';'.join(responses)
+
+    def query(self, command: str):
+        self._responses = []
+        self.write(command)
+        return self.read()
+
+    def read_raw(self):
+        return (self.read() + '\n').encode()
+
+    ####################
+    # SCPI parsing     #
+    ####################
+
+    @staticmethod
+    def header(text):
+        nodes = [node for node in text.upper().strip(':').split(':') if node]
+        nodes = [NODES.get(node, node) for node in nodes]
+        if nodes and nodes[0] == 'SOUR':
+            nodes = nodes[1:]
+        if len(nodes) > 1 and nodes[0] in ('CURR', 'VOLT', 'POW', 'RES') \
+                and nodes[1] == 'LEV' and nodes[-1] != 'ON':
+            nodes = nodes[:1] + nodes[2:]
+        nodes = [node for node in nodes if node != 'IMM']
+        header = ':'.join(nodes)
+        return ALIASES.get(header, header)
+
+    def _command(self, text):
+        head, _, args = text.partition(' ')
+        query = head.endswith('?')
+        header = self.header(head.rstrip('?'))
+        args = [arg.strip() for arg in args.split(',')] if args.strip() \
+            else []
+        if header.startswith('*'):
+            response = self._common(header, args, query)
+        elif query:
+            response = self._query(header, args)
+        else:
+            response = self._set(header, args)
+        if query:
+            self._responses.append('' if response is None else response)
+
+    def _error(self, text):
+        self._errors.append(text)
+        return None
+
+    def _common(self, header, args, query):
+        if header == '*IDN':
+            return 'Siglent Technologies,{},SDL00000000001,1.1.1.21'.format(
+                self.model)
+        if header == '*RST':
+            self.reset()
+        elif header == '*CLS':
+            self._errors = []
+        elif header == '*OPC':
+            return '1' if query else None
+        elif header == '*SAV' and args:
+            self._saved[args[0]] = (dict(self.state), dict(self.steps))
+        elif header == '*RCL' and args and args[0] in self._saved:
+            state, steps = self._saved[args[0]]
+            self.state, self.steps = dict(state), dict(steps)
+        elif header == '*TRG':
+            self.trigger_times.append(time.perf_counter())
+        elif header in ('*ESR', '*STB', '*ESE', '*SRE', '*TST'):
+            return '0' if query else None
+        elif header != '*WAI':
+            return self._error('-113,"Undefined header"')
+        return None
+
+    # Format a stored setting for a query response
+    @staticmethod
+    def _format(kind, value):
+        if kind == 'float':
+            return '{:f}'.format(value)
+        return str(value)
+
+    # Convert a parameter to the setting type, None if it is not valid
+    def _parse(self, kind, limits, text):
+        keyword = text.upper()
+        if kind == 'bool':
+            return {'ON': 1, 'OFF': 0, '1': 1, '0': 0}.get(keyword)
+        if kind == 'enum':
+            return KEYWORDS.get(keyword)
+        if limits is not None and keyword in ('MIN', 'MINIMUM'):
+            return limits[0]
+        if limits is not None and keyword in ('MAX', 'MAXIMUM'):
+            return limits[1]
+        try:
+            value = float(text)
+        except ValueError:
+            return None
+        if limits is not None and not limits[0] <= value <= limits[1]:
+            return None
+        return int(value) if kind == 'int' else value
+
+    def _set(self, header, args):
+        if header in FUNCTION_COMMANDS:
+            self.function = FUNCTION_COMMANDS[header]
+            return None
+        if header == 'FUNC' or header == 'FUNC:TRAN':
+            self.function = 'STATIC' if header == 'FUNC' else 'DYNAMIC'
+        if header in self._step_settings and len(args) == 2:
+            kind, _, limits = self._step_settings[header]
+            value = self._parse(kind, limits, args[1])
+            if value is None:
+                return self._error('-224,"Illegal parameter value"')
+            self.steps[(header, int(float(args[0])))] = value
+            return None
+        if header not in self._settings or len(args) != 1:
+            return self._error('-113,"Undefined header"')
+        kind, _, limits = self._settings[header]
+        value = self._parse(kind, limits, args[0])
+        if value is None:
+            return self._error('-224,"Illegal parameter value"')
+        if header == 'INP':
+            self._input_changed(value)
+        self.state[header] = value
+        return None
+
+    def _query(self, header, args):
+        if header.startswith('MEAS'):
+            return self._measure(header, args)
+        if header in FUNCTION_QUERIES:
+            return '1' if self.function == FUNCTION_QUERIES[header] else '0'
+        if header == 'BATT:DISCHA:CAP':
+            return '{:f}'.format(self._discharge()[0])
+        if header == 'BATT:DISCHA:TIM':
+            return '{:f}'.format(self._discharge()[1])
+        if header == 'TIME:TEST:RISE':
+            return '{:f}'.format(self._jitter(self.rise_time))
+        if header == 'TIME:TEST:FALL':
+            return '{:f}'.format(self._jitter(self.fall_time))
+        if header == 'PROG:TEST':
+            return '0'
+        if header == 'SYST:ERR':
+            return self._errors.pop(0) if self._errors else '0,"No error"'
+        if header in self._step_settings:
+            kind, default, _ = self._step_settings[header]
+            step = int(float(args[0])) if args else 1
+            return self._format(kind, self.steps.get((header, step), default))
+        if header in self._settings:
+            kind = self._settings[header][0]
+            return self._format(kind, self.state[header])
+        return self._error('-113,"Undefined header"')
+
+    ####################
+    # Input model      #
+    ####################
+
+    def _jitter(self, value):
+        return value * (1.0 + self._random.gauss(0.0, self.noise))
+
+    # Active sink mode and level of the input
+    def _setpoint(self):
+        if self.function == 'DYNAMIC':
+            mode = self.state['FUNC:TRAN']
+            root = MEASUREMENTS_ROOT[mode]
+            return mode, self.state[root + ':TRAN:ALEV']
+        if self.function == 'BATTERY':
+            return self.state['BATT:MODE'], self.state['BATT:LEV']
+        if self.function == 'STATIC':
+            mode = self.state['FUNC']
+            if mode == 'LED':
+                return 'LED', self.state['LED:CURR']
+            return mode, self.state[MEASUREMENTS_ROOT[mode]]
+        if self.function in ('OCP', 'OPP'):
+            return self._ramp(self.function)
+        return 'CURRENT', 0.0
+
+    # OCP/OPP test: from STAR up by STEP every STEP:DEL seconds to END
+    def _ramp(self, root):
+        mode = 'CURRENT' if root == 'OCP' else 'POWER'
+        start, end = self.state[root + ':STAR'], self.state[root + ':END']
+        step = self.state[root + ':STEP']
+        delay = max(self.state[root + ':STEP:DEL'], 1e-6)
+        if self._ramp_stamp is None or step <= 0:
+            return mode, start
+        steps = int((time.monotonic() - self._ramp_stamp) / delay)
+        return mode, min(start + steps * step, end)
+
+    # Voltage and current at the input for the present settings
+    def operating_point(self):
+        voc = self.source_voltage
+        r_source = max(self.source_resistance, 1e-6)
+        if not self.state['INP']:
+            return voc, 0.0
+        if self.state['SHOR']:
+            current = voc / r_source
+        else:
+            mode, level = self._setpoint()
+            if mode in ('CURRENT', 'LED'):
+                current = level
+            elif mode == 'VOLTAGE':
+                current = max(voc - level, 0.0) / r_source
+            elif mode == 'POWER':
+                disc = voc * voc - 4.0 * r_source * level
+                current = (voc - math.sqrt(disc)) / (2.0 * r_source) \
+                    if disc >= 0 else voc / (2.0 * r_source)
+            else:
+                current = voc / (r_source + max(level, 1e-6))
+        current = min(current, CURRENT[1])
+        if self.current_limit is not None and current > self.current_limit:
+            # Supply in current limit, the output collapses
+            return 0.0, self.current_limit
+        return max(voc - current * r_source, 0.0), current
+
+    def _measure(self, header, args):
+        voltage, current = self.operating_point()
+        values = {
+            'voltage': voltage, 'current': current,
+            'power': voltage * current,
+            'resistance': voltage / current if current else 1e9}
+        nodes = header.split(':')
+        if len(nodes) > 1 and nodes[1] == 'WAVE':
+            source = MEASUREMENTS.get(
+                self.header(args[0]) if args else 'VOLT', 'voltage')
+            return ','.join(
+                '{:f}'.format(self._jitter(values[source]))
+                for _ in range(WAVE_SAMPLES)) + ','
+        if len(nodes) > 1 and nodes[1] == 'EXT':
+            return '0.000000'
+        quantity = MEASUREMENTS.get(nodes[1] if len(nodes) > 1 else 'VOLT')
+        if quantity is None:
+            return self._error('-113,"Undefined header"')
+        return '{:f}'.format(self._jitter(values[quantity]))
+
+    def _input_changed(self, on):
+        # The OCP/OPP test ramp starts when the input is turned on
+        self._ramp_stamp = time.monotonic() if on else None
+        if self.function != 'BATTERY':
+            return
+        self._discharge()
+        if on and self._discharge_stamp is None:
+            self._discharge_stamp = time.monotonic()
+        elif not on:
+            self._discharge_stamp = None
+
+    # Discharged capacity (mAh) and time (s) of the battery test
+    def _discharge(self):
+        if self._discharge_stamp is not None:
+            now = time.monotonic()
+            elapsed = now - self._discharge_stamp
+            self._discharge_capacity += \
+                self.operating_point()[1] * elapsed / 3.6
+            self._discharge_time += elapsed
+            self._discharge_stamp = now
+        return self._discharge_capacity, self._discharge_time
@@ -0,0 +1,905 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+import siglent_sdl1000x as sdl
+from siglent_sdl1000x_sim import SimulatedLoad
+
+'''
+Driver tests run against SimulatedLoad, no instrument needed:
+
+    python -m pytest -q test_siglent_sdl1000x.py
+'''
+
+
+@pytest.fixture
+def sim():
+    return SimulatedLoad(seed=0, noise=0.0)
+
+
+@pytest.fixture
+def dev(sim):
+    return sdl.Device(transport=sim)
+
+
+# Bus transactions made by func()
+def transactions(sim, func):
+    start = sim.transactions
+    func()
+    return sim.transactions - start
+
+
+# Make the simulator's query() raise 'error' after 'count' more queries
+# containing 'match'. Returns a function undoing it
+def fail_after(sim, count, error=TimeoutError, match=''):
+    sim_query = sim.query
+    calls = [0]
+
+    def query(command):
+        calls[0] += match in command
+        if calls[0] > count:
+            raise error('simulated bus timeout')
+        return sim_query(command)
+
+    sim.query = query
+    return lambda: setattr(sim, 'query', sim_query)
+
+
+# Wait until a session has logged 'count' samples
+def wait_for_samples(session, count, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while session.count < count and session.running:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+##########
+# Device #
+##########
+
+def test_device_opens_with_one_query(sim):
+    start = sim.transactions
+    dev = sdl.Device(transport=sim)
+    assert sim.transactions - start == 1
+    assert dev._bus.input_values['model'] == 'SDL1020X-E'
+    assert 'cc' not in dev.__dict__ and 'test' not in dev.__dict__
+
+
+def test_modes_are_built_on_first_access(dev, sim):
+    sim.write(':FUNC VOLT')
+    assert transactions(sim, lambda: dev.cp) == 0
+    assert dev.cp is dev.cp
+    assert sim.state['FUNC'] == 'VOLTAGE'
+    # Settings are only read when 'values' is first used
+    assert transactions(sim, lambda: dev.cp.values) > 0
+    assert transactions(sim, lambda: dev.cp.values) == 0
+
+
+def test_devices_keep_their_own_input_state(dev, sim, capsys):
+    high_sim = SimulatedLoad(model='SDL1030X', seed=0, noise=0.0)
+    high = sdl.Device(transport=high_sim)
+    assert not dev._bus.input_values['high_power']
+    assert high._bus.input_values['high_power']
+    # The power range follows each device's own model
+    dev.cp.level(250)
+    assert 'ValueError' in capsys.readouterr().out
+    high.cp.level(250)
+    assert 'ValueError' not in capsys.readouterr().out
+    assert sim.state['POW'] == 1.0
+    assert high_sim.state['POW'] == 250.0
+    dev.cc.input_control('ON')
+    assert dev._bus.input_values['input_on'] == '1'
+    assert 'input_on' not in high._bus.input_values
+
+
+#########
+# Batch #
+#########
+
+def test_batch_splits_joined_response(dev, sim):
+    dev.cc.level(1.5)
+    dev.cv.level(7.25)
+    results = {}
+
+    def run():
+        with dev.batch():
+            dev.cc.slew_pos(0.5)
+            results['cc'] = dev.cc.level()
+            results['cv'] = dev.cv.level()
+            results['range'] = dev.cc.current_range()
+
+    assert transactions(sim, run) == 1
+    assert float(results['cc'].value) == 1.5
+    assert float(results['cv'].value) == 7.25
+    assert int(results['range'].value) == 30
+
+
+def test_batch_splits_long_batches_into_messages(dev, sim):
+    for step in range(1, 41):
+        dev.test.list.level(step, 0.1 * step)
+    levels = []
+
+    def run():
+        with dev.batch():
+            levels.extend(
+                dev.test.list.level(step) for step in range(1, 41))
+
+    count = transactions(sim, run)
+    assert count == -(-40 // sdl.MAX_MESSAGE_COMMANDS)
+    assert [float(level.value) for level in levels] == pytest.approx(
+        [0.1 * step for step in range(1, 41)])
+
+
+def test_batch_with_a_missing_response_raises(dev, sim):
+    sim.query = lambda command: '1.000000'
+    with pytest.raises(ValueError, match='2 queries'):
+        with dev.batch():
+            level = dev.cc.level()
+            dev.cv.level()
+    assert not level.done
+
+
+def test_query_many_checks_the_response_count(dev, sim):
+    assert dev._bus.query_many([':CURR?', ':VOLT?']) == [
+        '1.000000', '150.000000']
+    sim.query = lambda command: '1.000000;2.000000;3.000000'
+    with pytest.raises(ValueError, match='3 responses'):
+        dev._bus.query_many([':CURR?', ':VOLT?'])
+
+
+def test_values_read_inside_batch_are_resolved(dev):
+    with dev.batch():
+        values = dev.cc.values
+    assert not any(isinstance(value, sdl.BatchResult)
+                   for value in values['mode'].values())
+    assert dev.cc.values['mode']['level'] == '1.000000'
+    assert dev._bus.input_values['mode'] == 'STATIC CURRENT'
+
+
+def test_refresh_sets_the_mode_name(dev):
+    dev.cc.level(2)
+    dev.refresh()
+    assert dev._bus.input_values['mode'] == 'STATIC CURRENT'
+    assert float(dev.cc.values['mode']['level']) == 2.0
+
+
+###########################
+# Threads and DeviceGroup #
+###########################
+
+def test_threads_sharing_a_device_get_their_own_responses(dev, sim):
+    # A slow instrument, the response is read well after the query
+    def query(command):
+        sim.write(command)
+        time.sleep(0.0005)
+        return sim.read()
+
+    sim.query = query
+
+    def work(level):
+        for _ in range(20):
+            dev.test.list.level(level, level / 10)
+            assert float(dev.test.list.level(level)) == level / 10
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        for future in [pool.submit(work, level) for level in (1, 2, 3, 4)]:
+            future.result()
+
+
+def test_batches_are_kept_per_thread(dev, sim):
+    with dev.batch():
+        level = dev.cc.level()
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            # Another thread's getter is not queued in this batch
+            other = pool.submit(dev.cv.level).result()
+        assert not level.done
+    assert other == '150.000000'
+    assert level.value == '1.000000'
+
+
+def test_device_group_runs_on_every_device():
+    sims = [SimulatedLoad(seed=0, noise=0.0) for _ in range(3)]
+    with sdl.DeviceGroup(sims) as group:
+        assert len(group) == 3
+        group.call('cc.level', 2.5)
+        assert [sim.state['CURR'] for sim in sims] == [2.5] * 3
+        sims[1].state['VOLT'] = 12.0
+        assert group.map(lambda dev: float(dev.cv.level())) == [
+            150.0, 12.0, 150.0]
+
+
+def test_device_group_triggers_every_load_once(capsys):
+    sims = [SimulatedLoad(seed=0, noise=0.0) for _ in range(3)]
+    with sdl.DeviceGroup(sims) as group:
+        group.arm()
+        assert [sim.state['TRIG:SOUR'] for sim in sims] == ['BUS'] * 3
+        times = group.trigger()
+        assert [len(sim.trigger_times) for sim in sims] == [1, 1, 1]
+        assert times['sent'].min() == 0.0
+        assert (times['done'] >= times['sent']).all()
+        assert times['skew'] == pytest.approx(np.ptp(times['sent']))
+    with sdl.DeviceGroup(sims, max_workers=1) as group:
+        assert group.trigger() is None
+    assert 'worker per device' in capsys.readouterr().out
+    assert [len(sim.trigger_times) for sim in sims] == [1, 1, 1]
+
+
+def test_trigger_source_rejects_unknown_sources(dev, sim, capsys):
+    dev.trigger_source('ext')
+    assert sim.state['TRIG:SOUR'] == 'EXTERNAL'
+    assert dev.trigger_source('bogus') is None
+    assert 'Not in set' in capsys.readouterr().out
+    assert sim.state['TRIG:SOUR'] == 'EXTERNAL'
+
+
+##################
+# Write confirm  #
+##################
+
+def test_confirm_always_reads_back(dev, sim):
+    dev.cc.values
+    assert transactions(sim, lambda: dev.cc.level(2)) == 2
+    assert dev.cc.values['mode']['level'] == '2.000000'
+
+
+def test_confirm_never_keeps_sent_value(dev, sim):
+    dev.cc.values
+    dev.write_confirm('never')
+    assert transactions(sim, lambda: dev.cc.level(2)) == 1
+    assert float(dev.cc.values['mode']['level']) == 2.0
+
+
+def test_confirm_deferred_reads_back_on_confirm(dev, sim):
+    dev.cc.values
+    dev.write_confirm('deferred')
+
+    def run():
+        dev.cc.level(2)
+        dev.cc.slew_pos(1.0)
+
+    assert transactions(sim, run) == 2
+    assert dev.cc.values['mode']['level'] == '1.000000'
+    assert transactions(sim, dev.confirm) == 1
+    assert dev.cc.values['mode']['level'] == '2.000000'
+    assert dev.cc.values['mode']['slew_pos'] == '1.000000'
+
+
+def test_confirm_policy_block_confirms_on_exit(dev):
+    dev.cc.values
+    with dev.confirm_policy('deferred'):
+        dev.cc.level(2)
+    assert dev._bus._deferred == []
+    assert dev.cc.values['mode']['level'] == '2.000000'
+    assert dev.write_confirm() == 'always'
+
+
+##############################
+# List and program downloads #
+##############################
+
+def test_list_load_skips_unchanged_steps(dev, sim):
+    levels = [0.1 * step for step in range(1, 101)]
+    assert dev.test.list.load(levels, 0.5, 0.01) == []
+    assert transactions(
+        sim, lambda: dev.test.list.load(levels, 0.5, 0.01)) <= 2
+    levels[41] = 2.5
+    sent = []
+    sim_write = sim.write
+
+    def write(command):
+        sent.append(command)
+        sim_write(command)
+
+    sim.write = write
+    assert dev.test.list.load(levels, 0.5, 0.01) == []
+    assert sum(command.count(':LIST:LEV ') for command in sent) == 1
+    assert float(dev.test.list.level(42)) == 2.5
+
+
+def test_list_load_rejects_an_empty_list(dev, sim, capsys):
+    assert transactions(sim, lambda: dev.test.list.load([])) == 0
+    assert dev.test.list.load([]) is None
+    assert 'Not in range' in capsys.readouterr().out
+    assert sim.state['LIST:STEP'] == 2
+    assert dev.test.list.load([1.0] * 101) is None
+
+
+def test_list_load_writes_modes_and_counts(dev, sim):
+    assert dev.test.list.load([0.5, 1.0, 1.5], mode='CURR', count=3) == []
+    assert sim.state['LIST:STEP'] == 3
+    assert sim.state['LIST:COUN'] == 3
+    assert [float(dev.test.list.level(step)) for step in (1, 2, 3)] == \
+        [0.5, 1.0, 1.5]
+
+
+def test_prog_upload_writes_changed_cells_only(dev, sim):
+    table = dev.test.prog.download()
+    table['time_on'][0] = 2.0
+    sent = []
+    sim_write = sim.write
+
+    def write(command):
+        sent.append(command)
+        sim_write(command)
+
+    sim.write = write
+    assert dev.test.prog.upload(table) == []
+    writes = [part for command in sent for part in command.split(';')
+              if not part.endswith('?') and '? ' not in part]
+    assert len(writes) == 1
+    header, value = writes[0].split(',')
+    assert header == ':PROG:TIME:ON 1' and float(value) == 2.0
+    sent.clear()
+    assert dev.test.prog.upload(table) == []
+    assert sent == []
+
+
+#####################
+# Battery discharge #
+#####################
+
+def test_discharge_session_resumes_and_truncates(dev, tmp_path):
+    dev.test.bat.level(1.0)
+    session = dev.test.bat.discharge(
+        tmp_path, interval=0.001, checkpoint_every=5)
+    wait_for_samples(session, 20)
+    session.stop()
+    assert session.error is None
+    logged = session.read()
+    assert len(logged) == session.count
+
+    # A crash after a checkpoint leaves partial samples behind
+    for column in sdl.DischargeSession.columns:
+        with open(tmp_path / (column + '.f8'), 'ab') as file:
+            file.write(b'\x01\x02\x03')
+    with open(tmp_path / 'voltage.f8', 'ab') as file:
+        file.write(np.ones(3).tobytes())
+
+    resumed = sdl.DischargeSession(
+        dev.test.bat, tmp_path, interval=0.001, checkpoint_every=5)
+    resumed._resume()
+    assert resumed.resumed
+    assert resumed.count == session.count
+    assert resumed.charge_ah == session.charge_ah
+    for column in sdl.DischargeSession.columns:
+        assert (tmp_path / (column + '.f8')).stat().st_size == \
+            8 * session.count
+    np.testing.assert_array_equal(resumed.read(), logged)
+
+
+def test_discharge_session_integrates_charge(dev, tmp_path):
+    dev.test.bat.level(1.0)
+    session = dev.test.bat.discharge(tmp_path, interval=0.002)
+    wait_for_samples(session, 30)
+    session.stop()
+    data = session.read()
+    charge = np.trapezoid(data['current'], data['time']) / 3600.0
+    assert session.charge_ah == pytest.approx(charge)
+    assert session.energy_wh == pytest.approx(np.trapezoid(
+        data['voltage'] * data['current'], data['time']) / 3600.0)
+
+
+def test_discharge_session_ends_when_input_turns_off(dev, tmp_path):
+    session = dev.test.bat.discharge(tmp_path, interval=0.001)
+    wait_for_samples(session, 1)
+    dev.test.bat.input_control('OFF')
+    session._thread.join(5.0)
+    assert not session.running
+    assert session.error is None
+    assert session.read()['time'].size == session.count
+
+
+###################
+# Typed responses #
+###################
+
+def test_typed_getters(dev):
+    dev.typed(True)
+    dev.cc.level(1.5)
+    assert dev.cc.level() == 1.5
+    assert dev.cc.current_range() == 30
+    assert dev.cc.input_control() is False
+    assert dev.test.list.list_mode() is sdl.Mode.CURRENT
+    assert dev.test.list.list_mode() == 'CURRENT'
+    assert sdl.Mode('CURR') is sdl.Mode.CURRENT
+    assert dev.trigger_source() is sdl.TriggerSource.MANUAL
+
+
+def test_typed_batch_results(dev):
+    dev.typed(True)
+    with dev.batch():
+        level = dev.cc.level()
+        on = dev.cc.input_control()
+    assert level.value == 1.0
+    assert on.value is False
+
+
+def test_typed_single_quantity_measurements(dev):
+    dev.typed(True)
+    assert dev.meas.snapshot(('voltage',))['voltage'] == pytest.approx(12.0)
+    data = dev.meas.poll(2, quantities=('current',))
+    assert data['current'].tolist() == [0.0, 0.0]
+
+
+def test_untyped_getters_return_text(dev):
+    assert dev.cc.level() == '1.000000'
+
+
+#############
+# Waveforms #
+#############
+
+WAVE_REPLY = (','.join('{:f}'.format(0.01 * i) for i in range(200)) +
+              ',\n').encode()
+
+
+def test_parse_wave_decodes_raw_reply():
+    data = sdl.Measure.parse_wave(WAVE_REPLY)
+    assert data.dtype == np.float32
+    assert data == pytest.approx(0.01 * np.arange(200))
+
+
+def test_parse_wave_into_buffer():
+    out = np.zeros(sdl.WAVE_SAMPLES, dtype='f')
+    data = sdl.Measure.parse_wave(WAVE_REPLY, out=out)
+    assert np.shares_memory(data, out)
+    np.testing.assert_array_equal(data, sdl.Measure.parse_wave(WAVE_REPLY))
+    assert len(sdl.Measure.parse_wave(b'1,' * 300 + b'\n', out)) == 200
+    assert len(sdl.Measure.parse_wave(b'\n', out)) == 0
+
+
+def test_wave_voltage_reads_samples(dev):
+    dev.meas.wave_voltage()
+    assert dev.meas.wave_data['VOLT'] == pytest.approx(12.0, abs=0.1)
+
+
+def test_wave_stream_ring_keeps_latest_captures(dev):
+    stream = sdl.WaveStream(dev.meas, ('VOLT', 'CURR'), capacity=3)
+    for _ in range(5):
+        stream.capture()
+    times, volts = stream.latest('VOLT', 10)
+    assert volts.shape == (3, sdl.WAVE_SAMPLES)
+    assert np.all(np.diff(times) >= 0)
+    assert np.shares_memory(volts, stream._data['VOLT'])
+    assert stream.samples('CURR', 250).shape == (250,)
+
+
+def test_wave_stream_short_reply_leaves_no_stale_samples(dev, sim):
+    replies = [b'7,' * sdl.WAVE_SAMPLES + b'\n', b'1,2,3,\n']
+    sim.read_raw = lambda: replies.pop(0)
+    stream = sdl.WaveStream(dev.meas, ('VOLT',), capacity=1)
+    stream.capture()
+    stream.capture()
+    row = stream.latest('VOLT')[1][0]
+    assert row[:3].tolist() == [1.0, 2.0, 3.0]
+    assert np.isnan(row[3:]).all()
+
+
+def test_wave_stream_thread_runs_and_stops(dev):
+    with dev.meas.stream(('VOLT',), capacity=10) as stream:
+        deadline = time.monotonic() + 5.0
+        while stream.count < 3 and time.monotonic() < deadline:
+            time.sleep(0.001)
+    assert stream.count >= 3
+    assert not stream.running
+    assert stream.error is None
+
+
+####################
+# Snapshot / apply #
+####################
+
+def test_snapshot_apply_round_trip(dev, sim):
+    recipe = dev.snapshot()
+    assert recipe['cc']['level'] == 1.0
+    assert recipe['test.list']['list_mode'] is sdl.Mode.CURRENT
+    dev.cc.level(2.5)
+    dev.test.bat.t_stop(120)
+    dev.prot.current_state('ON')
+    written = dev.apply(recipe)
+    assert written == {'cc': {'level': 1.0}, 'test.bat': {'t_stop': 0},
+                       'prot': {'current_state': False}}
+    assert dev.diff(dev.snapshot(), recipe) == {}
+
+
+def test_apply_leaves_out_rejected_values(dev, sim, capsys):
+    written = dev.apply({'test.bat': {'t_stop': 120, 'level': 99.0}})
+    assert 'Not in range' in capsys.readouterr().out
+    assert written == {'test.bat': {'t_stop': 120}}
+    assert sim.state['BATT:TIM'] == 120
+    assert dev.apply({'test.bat': {'t_stop': 120}}) == {}
+
+
+def test_apply_reads_only_the_given_settings(dev, sim):
+    dev.cache(float('inf'))
+    dev.cc.level()
+    assert transactions(sim, lambda: dev.apply({'cc': {'level': 1.0}})) == 0
+    assert transactions(sim, lambda: dev.apply({'cc': {'level': 2.0}})) == 1
+    assert float(dev.cc.level()) == 2.0
+
+
+#################
+# Static sweeps #
+#################
+
+def test_sweep_returns_sorted_points_with_input_off(dev, sim):
+    curve = dev.cc.sweep([1.0, 0.5, 2.0], average=2)
+    assert curve['set'].tolist() == [0.5, 1.0, 2.0]
+    assert curve['current'] == pytest.approx(curve['set'], abs=1e-3)
+    assert curve['power'] == pytest.approx(
+        curve['voltage'] * curve['current'])
+    assert sim.state['INP'] == 0
+
+
+def test_sweep_turns_input_off_after_an_error(dev, sim):
+    restore = fail_after(sim, 5)
+    with pytest.raises(TimeoutError):
+        dev.cc.sweep([0.1 * point for point in range(20)])
+    restore()
+    assert sim.state['INP'] == 0
+    assert int(dev.cc.input_control()) == 0
+
+
+def test_sweep_rejects_out_of_range_setpoints(dev, sim):
+    assert transactions(sim, lambda: dev.cc.sweep([1.0, 99.0])) == 0
+
+
+#########################
+# OCP and OPP tests     #
+#########################
+
+@pytest.fixture
+def limited(sim):
+    # A 12 V supply folding back at 2 A, OCP trip below 5 V
+    sim.current_limit = 2.0
+    dev = sdl.Device(transport=sim)
+    dev.write(':OCP:VOLT 5')
+    return dev
+
+
+def test_ocp_run_reports_trip_with_input_off(limited, sim):
+    result = limited.test.ocp.run()
+    assert result['tripped']
+    assert 1.5 <= result['level'] <= 2.0
+    assert result['samples']['voltage'][-1] < 5.0
+    assert sim.state['INP'] == 0
+
+
+def test_ocp_run_releases_the_bus_between_polls(dev):
+    # No trip, the ramp is followed until the timeout
+    thread = threading.Thread(
+        target=dev.test.ocp.run, kwargs={'timeout': 0.5})
+    thread.start()
+    time.sleep(0.05)
+    start = time.perf_counter()
+    dev.meas.voltage()
+    assert time.perf_counter() - start < 0.1
+    thread.join(5.0)
+
+
+def test_ocp_run_turns_input_off_after_an_error(limited, sim):
+    restore = fail_after(sim, 2, match='MEAS')
+    with pytest.raises(TimeoutError):
+        limited.test.ocp.run()
+    restore()
+    assert sim.state['INP'] == 0
+
+
+def test_ocp_search_finds_trip_and_restores(limited, sim):
+    limited.cc.level(0.75)
+    limited.test.ocp.enable()
+    result = limited.test.ocp.search(0.5, 5.0, resolution=0.01, settle=0)
+    assert result['tripped']
+    assert result['level'] == pytest.approx(2.0, abs=0.01)
+    assert sim.state['INP'] == 0
+    assert float(limited.cc.level()) == 0.75
+    assert sim.function == 'OCP'
+    assert limited._bus.input_values['mode'] == 'OCP'
+
+
+def test_ocp_search_restores_after_reset_fails(limited, sim):
+    limited.cc.level(0.75)
+
+    def reset():
+        raise RuntimeError('supply did not recover')
+
+    with pytest.raises(RuntimeError):
+        limited.test.ocp.search(0.5, 5.0, settle=0, reset=reset)
+    assert sim.state['INP'] == 0
+    assert float(limited.cc.level()) == 0.75
+    assert limited._bus.input_values['mode'] == 'STATIC CURRENT'
+
+
+#############
+# Time test #
+#############
+
+def test_time_capture_statistics_with_cycle(dev, sim):
+    times = iter(0.001 * np.arange(1, 11))
+
+    def cycle():
+        sim.rise_time = next(times)
+
+    result = dev.test.time.capture(10, cycle=cycle)
+    assert result['stale'] == 0
+    assert result['rise']['count'] == 10
+    assert result['rise']['mean'] == pytest.approx(0.0055)
+    assert result['rise']['p50'] == pytest.approx(0.0055)
+    assert result['fall']['std'] == pytest.approx(0.0)
+
+
+def test_time_capture_marks_repeated_results_stale(dev):
+    result = dev.test.time.capture(5)
+    assert result['stale'] == 4
+    assert result['samples']['stale'].tolist() == [False] + [True] * 4
+    assert result['rise']['count'] == 1
+
+
+def test_time_capture_restores_state(dev, sim):
+    dev.test.time.capture(2)
+    assert sim.state['TIME:TEST'] == 0
+    dev.test.time.state('ON')
+    dev.test.time.capture(2)
+    assert sim.state['TIME:TEST'] == 1
+
+
+def test_time_capture_cycle_may_use_device_from_another_thread(dev, sim):
+    with ThreadPoolExecutor(1) as pool:
+        def cycle():
+            pool.submit(dev.cc.level, 1.0).result(timeout=2.0)
+            sim.rise_time *= 1.1
+
+        result = dev.test.time.capture(3, cycle=cycle)
+    assert result['stale'] == 0
+
+
+def test_statistics_ignores_nan():
+    stats = sdl.ModeTime.statistics(
+        [[1.0, 2.0], [3.0, np.nan], [5.0, 4.0]], percentiles=(50,))
+    assert stats[0] == pytest.approx({
+        'count': 3, 'mean': 3.0, 'std': np.std([1, 3, 5]),
+        'min': 1.0, 'max': 5.0, 'p50': 3.0})
+    assert stats[1]['count'] == 2
+    assert stats[1]['mean'] == 3.0
+
+
+################
+# Getter cache #
+################
+
+def test_cache_serves_getters_until_a_write(dev, sim):
+    dev.cache(float('inf'))
+    dev.cc.level()
+    assert transactions(sim, dev.cc.level) == 0
+    # The read-back of a setter refreshes the cached value
+    dev.cc.level(2)
+    assert transactions(sim, dev.cc.level) == 0
+    assert dev.cc.level() == '2.000000'
+    # Changes made behind the driver are seen after invalidate()
+    sim.state['CURR'] = 3.0
+    assert dev.cc.level() == '2.000000'
+    dev.invalidate()
+    assert dev.cc.level() == '3.000000'
+    # The input state is never cached
+    dev.cc.input_control()
+    assert transactions(sim, dev.cc.input_control) == 1
+
+
+@pytest.mark.parametrize('command', ['*RST', ':FUNC VOLT', ':BATT:FUNC',
+                                     ':SYST:LOCK ON'])
+def test_cache_is_cleared_by_state_changing_commands(dev, sim, command):
+    dev.cache(float('inf'))
+    dev.cc.level()
+    dev.write(command)
+    assert transactions(sim, dev.cc.level) == 1
+
+
+def test_cache_entries_expire_and_serve_batches(dev, sim):
+    dev.cache(0.05)
+    assert dev.cache() == 0.05
+    dev.cc.level()
+    with dev.batch():
+        level = dev.cc.level()
+    assert level.done and level.value == '1.000000'
+    time.sleep(0.06)
+    assert transactions(sim, dev.cc.level) == 1
+    dev.cache(None)
+    assert transactions(sim, dev.cc.level) == 1
+
+
+##############
+# Validation #
+##############
+
+def test_level_validators_read_the_sub_mode_once(dev, sim, capsys):
+    queries = []
+    sim_query = sim.query
+
+    def query(command):
+        queries.append(command)
+        return sim_query(command)
+
+    sim.query = query
+    for level in (1, 2, 3):
+        dev.test.bat.level(level)
+    assert queries.count(':BATT:MODE?') == 1
+    # The driver's own mode write updates the cached sub-mode
+    dev.test.bat.mode('VOLT')
+    del queries[:]
+    dev.test.bat.level(100)
+    assert queries == [':BATT:LEV?']
+    assert sim.state['BATT:LEV'] == 100.0
+    dev.test.bat.mode('CURR')
+    del queries[:]
+    dev.test.bat.level(100)
+    assert queries == []
+    assert 'Not in range' in capsys.readouterr().out
+    # *RST drops it, the next level is checked against a new read
+    dev._com.rst()
+    assert dev._bus.modes == {}
+    del queries[:]
+    dev.test.bat.level(1)
+    assert queries == [':BATT:MODE?', ':BATT:LEV?']
+
+
+def test_rule_accepts_only_short_and_long_keywords():
+    rule = sdl.Rule(keywords=('CURRent', 'VOLTage'))
+    assert rule.check('curr') == 'CURR'
+    assert rule.check('Current') == 'CURRENT'
+    for value in ('CURRE', 'CUR', 'xCURR', ''):
+        assert isinstance(rule.check(value), ValueError)
+    assert isinstance(rule.check(1), TypeError)
+
+
+def test_rule_checks_numbers_and_keywords():
+    rule = sdl.Rule((0, 1), ('ON', 'OFF'), integer=True, span=False)
+    assert [rule.check(value) for value in ('on', 1, True)] == [
+        'ON', '1', '1']
+    assert isinstance(rule.check('ONN'), ValueError)
+    assert isinstance(rule.check(2), ValueError)
+    assert isinstance(rule.check(1.0), TypeError)
+    rule = sdl.Rule((0.0, 30.0), ('MINimum', 'MAXimum'))
+    assert rule.check_many(np.array([0.0, 30.0])) == ['0.0', '30.0']
+    assert rule.check_many([1, 'max']) == ['1', 'MAX']
+    assert isinstance(rule.check_many([1, 2, 31]), ValueError)
+    assert isinstance(rule.check_many([1, 'maxi']), ValueError)
+    assert sdl.compile_rule((0, 1)) is sdl.compile_rule((0, 1))
+
+
+def test_rejected_keyword_sends_nothing(dev, sim, capsys):
+    assert transactions(sim, lambda: dev.test.bat.mode('CURRE')) == 0
+    assert 'Not in set' in capsys.readouterr().out
+    assert sim.state['BATT:MODE'] == 'CURRENT'
+
+
+###########
+# asyncio #
+###########
+
+def test_async_device_calls_methods_and_properties(dev, sim):
+    async def run():
+        adev = sdl.AsyncDevice(dev)
+        await adev.cc.level(2)
+        level = await adev.cc.level()
+        values = await adev.cc.values
+        # One executor call for a whole batch
+        batch = await adev.run(lambda dev: transactions(sim, dev.refresh))
+        return level, values, batch
+
+    level, values, batch = asyncio.run(run())
+    assert level == '2.000000'
+    assert values['mode']['level'] == '2.000000'
+    assert batch == 1
+    assert sim.state['CURR'] == 2.0
+
+
+def test_async_device_drives_loads_concurrently():
+    sims = [SimulatedLoad(seed=0, noise=0.0) for _ in range(3)]
+
+    async def run():
+        adevs = await asyncio.gather(*(
+            sdl.AsyncDevice.open(transport=sim) for sim in sims))
+        await asyncio.gather(*(
+            adev.cc.level(index + 1) for index, adev in enumerate(adevs)))
+        return await asyncio.gather(*(adev.cc.level() for adev in adevs))
+
+    assert asyncio.run(run()) == ['1.000000', '2.000000', '3.000000']
+    assert [sim.state['CURR'] for sim in sims] == [1.0, 2.0, 3.0]
+
+
+###########
+# Tracing #
+###########
+
+def test_tracer_records_transactions_and_callers(dev, sim):
+    tracer = dev.trace()
+    dev.cc.level(2)
+    with dev.batch():
+        dev.cc.level()
+        dev.cv.level()
+    summary = tracer.summary()
+    assert summary['headers'] == {':CURR': 1, ':CURR?': 2, ':VOLT?': 1}
+    assert set(summary['messages']) == {':CURR', ':CURR?', ':CURR?;:VOLT?'}
+    assert summary['callers']['ModeCC.level']['count'] == 2
+    # The batch is sent from the with block in the test
+    assert summary['callers'][
+        'test_tracer_records_transactions_and_callers']['count'] == 1
+    assert [event['kind'] for event in tracer.events] == [
+        'write', 'query', 'query']
+    assert dev.trace(False) is tracer
+    assert transactions(sim, dev.cc.level) == 1
+    assert len(tracer.events) == 3
+
+
+def test_tracer_exports(dev, tmp_path):
+    tracer = dev.trace()
+    dev.cc.level(2)
+    tracer.export_jsonl(tmp_path / 'trace.jsonl')
+    tracer.export_chrome(tmp_path / 'trace.json')
+    lines = (tmp_path / 'trace.jsonl').read_text().splitlines()
+    assert [json.loads(line)['command'] for line in lines] == [
+        ':CURR 2', ':CURR?']
+    with open(tmp_path / 'trace.json') as file:
+        trace = json.load(file)['traceEvents']
+    assert [event['name'] for event in trace] == [':CURR', ':CURR?']
+    assert all(event['ph'] == 'X' and event['dur'] >= 0 for event in trace)
+    tracer.clear()
+    assert tracer.summary()['headers'] == {} and not tracer.events
+
+
+####################
+# Socket transport #
+####################
+
+# SCPI server on localhost answering from a SimulatedLoad
+class SimulatedServer:
+    def __init__(self, sim):
+        self.sim = sim
+        self._server = socket.create_server(('127.0.0.1', 0))
+        self.port = self._server.getsockname()[1]
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        connection, _ = self._server.accept()
+        with connection, connection.makefile('rb') as lines:
+            for line in lines:
+                command = line.decode().strip()
+                if '?' in command:
+                    response = self.sim.query(command)
+                    if command.upper().startswith('MEAS:WAVE'):
+                        response += ','
+                    connection.sendall(response.encode() + b'\n')
+                else:
+                    self.sim.write(command)
+
+    def close(self):
+        self._server.close()
+        self._thread.join(5.0)
+
+
+def test_socket_transport_round_trip(sim):
+    server = SimulatedServer(sim)
+    try:
+        dev = sdl.Device(
+            transport=sdl.SocketTransport('127.0.0.1', server.port))
+        dev.cc.level(2.5)
+        assert dev.cc.level() == '2.500000'
+        with dev.batch():
+            level = dev.cc.level()
+            voltage = dev.meas.voltage()
+        assert level.value == '2.500000'
+        assert float(voltage.value) == pytest.approx(12.0)
+        dev.meas.wave_voltage()
+        assert dev.meas.wave_data['VOLT'].shape == (sdl.WAVE_SAMPLES,)
+        dev.disconnect()
+    finally:
+        server.close()